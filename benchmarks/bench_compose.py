@@ -0,0 +1,29 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+Measures how long it takes to compose (build and compile) a large graph.
+
+Usage: python benchmarks/bench_compose.py [number_of_operations]
+"""
+
+import sys
+import time
+
+from operator import add
+
+from graphkit import operation, compose
+
+
+def main(n=50000):
+    ops = [operation(name='op%d' % i, needs=['d%d' % (i - 1) if i else 'a', 'a'], provides='d%d' % i)(add)
+           for i in range(n)]
+
+    t0 = time.time()
+    graph = compose(name='graph')(*ops)
+    elapsed = time.time() - t0
+
+    print("composed %d operations (%d steps) in %.3fs" % (n, len(graph.net.steps), elapsed))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
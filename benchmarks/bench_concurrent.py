@@ -0,0 +1,47 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+Measures the throughput of many threads calling the same composed graph at
+once.  The operations release the GIL (they sleep, like I/O bound code
+would), so throughput should scale with the number of threads.
+
+Usage: python benchmarks/bench_concurrent.py [calls_per_thread] [op_seconds]
+"""
+
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from graphkit import operation, compose
+
+
+def main(calls=200, op_seconds=0.001):
+
+    def io_add(a, b):
+        time.sleep(op_seconds)
+        return a + b
+
+    graph = compose(name='graph')(
+        operation(name='sum1', needs=['a', 'b'], provides='c')(io_add),
+        operation(name='sum2', needs=['c', 'b'], provides='d')(io_add),
+        operation(name='sum3', needs=['c', 'd'], provides='e')(io_add),
+    )
+
+    def worker(seed):
+        for i in range(calls):
+            results = graph({'a': seed + i, 'b': 1}, outputs=['e'])
+            assert results == {'e': 2 * (seed + i) + 3}
+
+    baseline = None
+    for threads in (1, 2, 4, 8, 16):
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(worker, range(threads)))
+        throughput = threads * calls / (time.time() - t0)
+        baseline = baseline or throughput
+        print("%2d threads: %8.0f calls/s (x%.1f)" % (threads, throughput, throughput / baseline))
+
+
+if __name__ == '__main__':
+    main(*[float(arg) if '.' in arg else int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,38 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+Measures the per-step overhead saved by fusing a long linear chain of cheap
+operations into a single step.
+
+Usage: python benchmarks/bench_fusion.py [chain_length] [calls]
+"""
+
+import sys
+import time
+
+from operator import add
+
+from graphkit import operation, compose
+
+
+def main(n=1000, calls=200):
+    ops = [operation(name='op%d' % i, needs=['d%d' % (i - 1) if i else 'a', 'a'], provides='d%d' % i)(add)
+           for i in range(n)]
+    output = ['d%d' % (n - 1)]
+
+    for fuse in (False, True):
+        graph = compose(name='graph', fuse=fuse)(*ops)
+        steps = len(graph.net.steps)
+        assert graph({'a': 1}, outputs=output) == {output[0]: n + 1}
+
+        t0 = time.time()
+        for _ in range(calls):
+            graph({'a': 1}, outputs=output)
+        elapsed = time.time() - t0
+
+        print("fuse=%-5s %5d steps: %.3fs per call, %.2fus per operation" %
+              (fuse, steps, elapsed / calls, 1e6 * elapsed / calls / n))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,47 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+Measures the memory taken by a large composed graph, and how fast plans are
+looked up in it.
+
+Usage: python benchmarks/bench_memory.py [number_of_operations]
+"""
+
+import gc
+import sys
+import time
+import tracemalloc
+
+from operator import add
+
+from graphkit import operation, compose
+
+
+def main(n=100000):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    ops = [operation(name='op%d' % i, needs=['d%d' % (i - 1) if i else 'a', 'a'], provides='d%d' % i)(add)
+           for i in range(n)]
+    graph = compose(name='graph')(*ops)
+    del ops
+    gc.collect()
+
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    nodes = graph.net.graph.number_of_nodes()
+    print("%d operations, %d nodes, %d steps: %.1f MB, %d bytes per node" %
+          (n, nodes, len(graph.net.steps), size / 1e6, size / nodes))
+
+    # planning walks the graph and filters every step
+    best = None
+    for _ in range(3):
+        t0 = time.time()
+        graph.net._plan_necessary_steps(['d%d' % (n - 1)], {'a': 1}, None)
+        elapsed = time.time() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print("planned the last output in %.3fs" % best)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
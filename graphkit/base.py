@@ -1,6 +1,31 @@
 # Copyright 2016, Yahoo Inc.
 # Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
 
+import sys
+
+from .singleflight import SingleFlight, fingerprint
+
+
+def _intern(name):
+    """Interns string names, so equal names compare by identity."""
+    return sys.intern(name) if type(name) is str else name
+
+
+# the optional attributes of operations, pickled along with their name,
+# needs, provides and params
+_OPTIONAL_ATTRIBUTES = ('color', 'chunk_safe', 'reduce', 'batched', 'io_bound', 'resources', 'stream')
+
+
+def check_output_types(operation, layer_outputs):
+    """
+    Raises a ``TypeError`` if any of the values computed by ``operation`` do
+    not match the type declared for it in the operation's ``provides``.
+    """
+    for output in operation.provides:
+        if output.name in layer_outputs and not isinstance(layer_outputs[output.name], output.type):
+            raise TypeError("Type mismatch. Operation: %s Output: %s Expected: %s Got: %s" %
+                            (operation.name, output.name, output.type, type(layer_outputs[output.name])))
+
 
 class Operation(object):
     """
@@ -27,14 +52,45 @@ class Operation(object):
                             accessible using the ``.params`` attribute of your object.
                             NOTE: It's important that any values stored in this
                             argument must be pickelable.
+
+        :param bool chunk_safe: Whether this layer works row by row, so it can
+                                be run on blocks of rows of its inputs (see
+                                :mod:`graphkit.chunked`).
+
+        :param function reduce: Combines the list of results this layer gave
+                                for every block of rows into the whole result,
+                                when it is run on blocks of rows.
+
+        :param bool batched: Whether this layer can run on the inputs of many
+                             calls stacked along a new first axis, returning
+                             outputs stacked the same way (see
+                             :mod:`graphkit.batching`).
+
+        :param bool io_bound: Whether this layer mostly waits on I/O, so it
+                              can be started in the background as soon as
+                              its needs are computed, overlapping the layers
+                              run in between.
+
+        :param dict resources: The amount of every resource this layer holds
+                               while it runs, e.g. ``{'mem_gb': 4, 'db': 1}``
+                               (see :mod:`graphkit.scheduler`).
+
+        :param bool stream: Whether this layer produces or consumes streams
+                            of items (see :mod:`graphkit.streaming`).
         """
 
         # (Optional) names for this layer, and the data it needs and provides
-        self.name = kwargs.get('name')
+        self.name = _intern(kwargs.get('name'))
         self.needs = kwargs.get('needs')
         self.provides = kwargs.get('provides')
         self.params = kwargs.get('params', {})
         self.color = kwargs.get('color', None)
+        self.chunk_safe = kwargs.get('chunk_safe', False)
+        self.reduce = kwargs.get('reduce', None)
+        self.batched = kwargs.get('batched', False)
+        self.io_bound = kwargs.get('io_bound', False)
+        self.resources = kwargs.get('resources', None)
+        self.stream = kwargs.get('stream', False)
         self.order = 0
 
         # call _after_init as final step of initialization
@@ -96,7 +152,9 @@ class Operation(object):
         This allows your operation to be pickled.
         Everything needed to instantiate your operation should be defined by the
         following attributes: params, needs, provides, and name
-        No other piece of state should leak outside of these 4 variables
+        No other piece of state should leak outside of these 4 variables,
+        besides the optional attributes declared with them (color,
+        resources...), which are kept when set.
         """
 
         result = {}
@@ -107,6 +165,9 @@ class Operation(object):
         result["needs"] = self.__dict__['needs']
         result["provides"] = self.__dict__['provides']
         result["name"] = self.__dict__['name']
+        for key in _OPTIONAL_ATTRIBUTES:
+            if key in self.__dict__:
+                result[key] = self.__dict__[key]
 
         return result
 
@@ -132,10 +193,19 @@ class Operation(object):
 class NetworkOperation(Operation):
     def __init__(self, **kwargs):
         self.net = kwargs.pop('net')
+        self.coalesce = kwargs.pop('coalesce', False)
         Operation.__init__(self, **kwargs)
 
-    def _compute(self, named_inputs, outputs=None, color=None):
-        return self.net.compute(outputs, named_inputs, color)
+    def _after_init(self):
+        # concurrent calls with the same fingerprint share one execution
+        self._flights = SingleFlight() if getattr(self, 'coalesce', False) else None
+
+    def _compute(self, named_inputs, outputs=None, color=None, lazy=False, memory=False):
+        if self._flights is not None and not lazy and not memory:
+            key = (self.coalesce if callable(self.coalesce) else fingerprint)(named_inputs, outputs, color)
+            if key is not None:
+                return dict(self._flights.do(key, lambda: self.net.compute(outputs, named_inputs, color)))
+        return self.net.compute(outputs, named_inputs, color, lazy=lazy, memory=memory)
 
     def __call__(self, *args, **kwargs):
         return self._compute(*args, **kwargs)
@@ -146,6 +216,61 @@ class NetworkOperation(Operation):
     def __getstate__(self):
         state = Operation.__getstate__(self)
         state['net'] = self.__dict__['net']
+        state['coalesce'] = self.__dict__.get('coalesce', False)
+        return state
+
+
+class AliasOperation(Operation):
+    """
+    An operation that provides, under its own names, the values of the data
+    it needs: the i-th of its ``provides`` gets the value of the i-th of its
+    ``needs``.  It stands in for operations found to be structurally
+    identical to another one, so their results are computed only once.
+    """
+
+    def _compute(self, named_inputs, outputs=None):
+        results = {}
+        for need, provide in zip(self.needs, self.provides):
+            if need.name in named_inputs and (not outputs or provide.name in outputs):
+                results[provide.name] = named_inputs[need.name]
+        return results
+
+
+class FusedOperation(Operation):
+    """
+    Runs a linear chain of operations back to back as a single step.  Every
+    operation of the chain consumes what the previous one provides, which
+    nothing else does, so only the provides of the last one are visible.
+    """
+
+    def __init__(self, **kwargs):
+        self.operations = kwargs.pop('operations')
+        Operation.__init__(self, **kwargs)
+
+    def _after_init(self):
+        self._needs = [[n.name for n in op.needs] for op in self.operations]
+        self._checked = [any(p.type is not object for p in op.provides) for op in self.operations]
+
+    def _compute(self, named_inputs, outputs=None):
+        results = {}
+        for op, needs, checked in zip(self.operations, self._needs, self._checked):
+            inputs = {}
+            for name in needs:
+                if name in results:
+                    inputs[name] = results[name]
+                elif name in named_inputs:
+                    inputs[name] = named_inputs[name]
+            results = op._compute(inputs)
+            if checked:
+                check_output_types(op, results)
+
+        if outputs:
+            return {k: v for k, v in results.items() if k in outputs}
+        return results
+
+    def __getstate__(self):
+        state = Operation.__getstate__(self)
+        state['operations'] = self.__dict__['operations']
         return state
 
 
@@ -182,11 +307,21 @@ class Var(object):
     Class for specifying optional types for inputs and outputs of graph nodes.
     """
 
+    __slots__ = ('name', 'type', 'optional')
+
     def __init__(self, name, type=object, optional=False):
-        self.name = name
+        self.name = _intern(name)
         self.type = type
         self.optional = optional
 
+    def __getstate__(self):
+        return {'name': self.name, 'type': self.type, 'optional': self.optional}
+
+    def __setstate__(self, state):
+        self.name = _intern(state['name'])
+        self.type = state['type']
+        self.optional = state.get('optional', False)
+
     def __repr__(self):
         return 'Var(name=%s, type=%s, optional=%s)' % (self.name, self.type, self.optional)
 
@@ -195,6 +330,9 @@ class Var(object):
         Operation equality is based on name of layer.
         (__eq__ and __hash__ must be overridden together)
         """
+        if other.__class__ is Var:
+            return self.name is not None and self.name == other.name and \
+                self.type is not None and self.type == other.type
         return bool((self.name is not None and
                     self.name == getattr(other, 'name', None)) and
                     self.type is not None and
@@ -0,0 +1,200 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a micro-batching front end for a composed graph.
+Requests arriving within a short time window are run through the graph
+together: operations declared with ``batched=True`` are called once with
+the inputs of all requests stacked along a new first axis, the others once
+per request.  Every caller gets its own slice of the results::
+
+    from graphkit.batching import MicroBatcher
+
+    with MicroBatcher(graph, outputs=['scores'], max_batch_size=64, max_wait=0.002) as batcher:
+        scores = batcher.compute({'features': features})['scores']
+"""
+
+import time
+import threading
+
+from queue import Queue, Empty
+from concurrent.futures import Future
+
+from .base import Operation, NetworkOperation, Control
+from .network import check_output_types
+
+
+class _Batch(object):
+    """The data of a batch of requests, stacked, per request or shared by all."""
+
+    def __init__(self, requests, shared):
+        self.size = len(requests)
+        self.items = {name: [inputs[name] for inputs in requests] for name in requests[0]}
+        self.stacked = {}
+        self.shared = shared
+
+    def __contains__(self, name):
+        return name in self.items or name in self.stacked or name in self.shared
+
+    def is_shared(self, name):
+        return name in self.shared and name not in self.items and name not in self.stacked
+
+    def whole(self, name):
+        if name in self.stacked:
+            return self.stacked[name]
+        if name in self.items:
+            import numpy as np
+            self.stacked[name] = np.stack(self.items[name])
+            return self.stacked[name]
+        return self.shared[name]
+
+    def item(self, name, i):
+        if name in self.items:
+            return self.items[name][i]
+        if name in self.stacked:
+            return self.stacked[name][i]
+        return self.shared[name]
+
+
+class MicroBatcher(object):
+    """
+    Collects the requests to a composed graph into batches, and runs every
+    batch through the graph at once from a background thread.
+
+    :param graph:
+        A ``NetworkOperation`` created with ``compose``, or a compiled
+        ``Network``.
+
+    :param list outputs:
+        The outputs requested by default.  If ``None``, all the data
+        computed from the inputs is returned.
+
+    :param int max_batch_size:
+        The largest number of requests run together.
+
+    :param float max_wait:
+        How long, in seconds, the first request of a batch waits for others
+        to join it.
+    """
+
+    def __init__(self, graph, outputs=None, max_batch_size=32, max_wait=0.005):
+        assert max_batch_size > 0, "max_batch_size must be positive"
+        self.net = graph.net if isinstance(graph, NetworkOperation) else graph
+        assert self.net.steps, "network must be compiled before batching calls."
+        self.outputs = outputs
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        # the number of batches run and of requests they held
+        self.batches = 0
+        self.requests = 0
+
+        self._queue = Queue()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, named_inputs, outputs=None):
+        """
+        Queues a request and returns a ``concurrent.futures.Future`` of its
+        results, a dict of output data keyed by name.
+        """
+        future = Future()
+        self._queue.put((named_inputs, outputs or self.outputs, future))
+        return future
+
+    def compute(self, named_inputs, outputs=None):
+        """Queues a request and waits for its results."""
+        return self.submit(named_inputs, outputs).result()
+
+    def close(self):
+        """Runs the requests already queued, then stops the thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            request = self._queue.get()
+            if request is None:
+                break
+
+            batch = [request]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    request = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+
+            # requests can only share a run if they have the same inputs and outputs
+            groups = {}
+            for request in batch:
+                outputs = tuple(request[1]) if request[1] else None
+                groups.setdefault((tuple(sorted(request[0])), outputs), []).append(request)
+            for (_, outputs), requests in groups.items():
+                self._run(requests, list(outputs) if outputs else None)
+
+    def _run(self, requests, outputs):
+        self.batches += 1
+        self.requests += len(requests)
+        try:
+            results = self._compute_batch([r[0] for r in requests], outputs)
+        except Exception:
+            # find out which requests fail by running them one at a time
+            for named_inputs, _, future in requests:
+                try:
+                    future.set_result(self.net.compute(outputs, named_inputs))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), result in zip(requests, results):
+            future.set_result(result)
+
+    def _compute_batch(self, requests, outputs):
+        """Runs the graph once for a list of named inputs with the same names."""
+        net = self.net
+        batch = _Batch(requests, dict(net.constants))
+        steps = net._find_necessary_steps(outputs, net._add_constants(requests[0]), None)
+        if any(isinstance(step, Control) for step in steps):
+            raise TypeError("Control flow operations can not be run in batches")
+
+        # data folded from constants is returned like the data computed here
+        computed = [name for name in net.constants if name in net.folded]
+        for op in (step for step in steps if isinstance(step, Operation)):
+            names = [n.name for n in op.needs if n.name in batch]
+
+            all_shared = all(batch.is_shared(name) for name in names)
+            if all_shared or getattr(op, 'batched', False):
+                # run once, on stacked data unless it's the same for all requests
+                t0 = time.time()
+                layer_outputs = op._compute({name: batch.whole(name) for name in names})
+                net._record_time(op.name, time.time() - t0)
+                check_output_types(op, layer_outputs)
+                (batch.shared if all_shared else batch.stacked).update(layer_outputs)
+            else:
+                per_item = []
+                for i in range(batch.size):
+                    t0 = time.time()
+                    layer_outputs = op._compute({name: batch.item(name, i) for name in names})
+                    net._record_time(op.name, time.time() - t0)
+                    check_output_types(op, layer_outputs)
+                    per_item.append(layer_outputs)
+                for p in op.provides:
+                    if all(p.name in layer_outputs for layer_outputs in per_item):
+                        batch.items[p.name] = [layer_outputs[p.name] for layer_outputs in per_item]
+            computed.extend(p.name for p in op.provides)
+
+        if not outputs:
+            outputs = [name for name in computed if name not in requests[0] and name in batch]
+        return [{name: batch.item(name, i) for name in outputs if name in batch}
+                for i in range(batch.size)]
@@ -0,0 +1,150 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains the checkpointing of long running calls: after the
+selected steps, the data still alive in the cache of a call is saved to a
+directory, from which a later call with the same inputs and outputs resumes,
+skipping the steps already done::
+
+    net.compute(['report'], inputs, checkpoint='/tmp/nightly')
+
+    # after a crash
+    net.compute(['report'], inputs, checkpoint='/tmp/nightly', resume_from='/tmp/nightly')
+
+Numpy arrays of at least ``mmap_threshold`` bytes are saved in ``.npy``
+files of their own, written once however many checkpoints hold them, and
+memory-mapped read-only on resume.  Other data is pickled.
+"""
+
+import os
+import sys
+import uuid
+import pickle
+import weakref
+import tempfile
+
+from .base import Operation
+
+_STATE = 'checkpoint.pickle'
+
+
+def _step_key(step):
+    if isinstance(step, Operation):
+        return ('op', step.name)
+    return ('del', str(step))
+
+
+def _is_large_array(value, threshold):
+    np = sys.modules.get('numpy')
+    return np is not None and isinstance(value, np.ndarray) and \
+        value.dtype != object and value.nbytes >= threshold
+
+
+class Checkpoint(object):
+    """
+    Where, and after which steps, the data cache of a call is saved.
+
+    :param str directory:
+        The directory holding the checkpoint, created if needed.  A call
+        replaces the checkpoint found there.
+
+    :param list after:
+        The names of the operations after which to save.  If ``None``, the
+        cache is saved after every operation.
+
+    :param int mmap_threshold:
+        The size, in bytes, from which numpy arrays are saved in files of
+        their own and memory-mapped on resume.
+
+    :ivar int saves: The number of checkpoints saved.
+    """
+
+    def __init__(self, directory, after=None, mmap_threshold=1 << 20):
+        self.directory = directory
+        self.after = set(after) if after is not None else None
+        self.mmap_threshold = mmap_threshold
+        self.saves = 0
+
+        # the array files written, by data name, with a weak reference to
+        # the array they hold so unchanged arrays aren't written again
+        self._arrays = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _wants(self, step):
+        return self.after is None or step.name in self.after
+
+    def _save(self, plan, done, cache, if_true=False):
+        """
+        Saves the ``cache`` of a call having run the first ``done`` steps of
+        ``plan``, and whether it was in the taken branch of an if/else chain.
+        """
+        values, arrays = {}, {}
+        for name, value in cache.items():
+            if _is_large_array(value, self.mmap_threshold):
+                arrays[name] = self._write_array(name, value)
+            else:
+                values[name] = value
+
+        state = {'plan': plan, 'done': done, 'values': values, 'arrays': arrays, 'if_true': if_true}
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, os.path.join(self.directory, _STATE))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.saves += 1
+
+        # forget the arrays no longer alive
+        kept = set(arrays.values())
+        for name in list(self._arrays):
+            if name not in arrays:
+                del self._arrays[name]
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.npy') and filename not in kept:
+                os.unlink(os.path.join(self.directory, filename))
+
+    def _write_array(self, name, value):
+        written = self._arrays.get(name)
+        if written is not None and written[0]() is value:
+            return written[1]
+
+        import numpy as np
+        filename = '%s.npy' % uuid.uuid4().hex
+        np.save(os.path.join(self.directory, filename), value)
+        self._arrays[name] = (weakref.ref(value), filename)
+        return filename
+
+    def _adopt(self, name, value, filename):
+        """Records that ``value``, resumed from this directory, is already saved."""
+        self._arrays[name] = (weakref.ref(value), filename)
+
+
+def resume(directory, plan, checkpoint=None):
+    """
+    Loads the checkpoint saved in ``directory`` by a call running the same
+    ``plan``, a list of step keys.  Returns the number of steps done, the
+    data cache, with large arrays memory-mapped, and whether the call was in
+    the taken branch of an if/else chain.
+
+    :raises ValueError: if the checkpoint was saved by a different plan,
+                        e.g. for other inputs or outputs.
+    """
+    with open(os.path.join(directory, _STATE), 'rb') as f:
+        state = pickle.load(f)
+    if state['plan'] != plan:
+        raise ValueError("The checkpoint in '%s' was saved for other inputs or outputs" % directory)
+
+    cache = dict(state['values'])
+    if state['arrays']:
+        import numpy as np
+        same_directory = checkpoint is not None and \
+            os.path.abspath(checkpoint.directory) == os.path.abspath(directory)
+        for name, filename in state['arrays'].items():
+            cache[name] = np.load(os.path.join(directory, filename), mmap_mode='r')
+            if same_directory:
+                checkpoint._adopt(name, cache[name], filename)
+    return state['done'], cache, state['if_true']
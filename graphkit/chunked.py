@@ -0,0 +1,162 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module runs a compiled network over blocks of rows of arrays too
+large for memory (NumPy arrays or ``np.memmap`` files), so that only one
+block of every intermediate array is held at a time::
+
+    from graphkit.chunked import compute_chunked
+
+    out = {'y': np.lib.format.open_memmap('y.npy', mode='w+', dtype='f8', shape=x.shape)}
+    results = compute_chunked(graph, ['y', 'total'], {'x': x}, chunked=['x'],
+                              chunk_size=100000, out=out)
+
+Operations consuming blocks of rows must declare how they do it: with
+``chunk_safe=True`` if they work row by row, so their outputs are blocks of
+rows too, or with a ``reduce`` function combining their results for all
+blocks into one.  Operations that don't depend on the chunked inputs run
+once, before or after the blocks as their needs require.
+"""
+
+from .base import Operation, NetworkOperation, Control
+from .network import ExecutionContext
+
+
+def _split_phases(ops, chunked):
+    """
+    Splits the operations of a plan into those running once before the
+    blocks, those running on every block and those running once after the
+    blocks, on reduced data.  Also returns the names of the data split in
+    blocks.
+    """
+    blocks = set(chunked)
+    reduced = set()
+    before, per_block, after = [], [], []
+
+    for op in ops:
+        needs = set(n.name for n in op.needs)
+        provides = [p.name for p in op.provides]
+
+        if needs & blocks:
+            if needs & reduced:
+                raise ValueError("operation '%s' needs both blocks of rows and "
+                                 "data reduced from all blocks" % op.name)
+            if getattr(op, 'reduce', None) is not None:
+                reduced.update(provides)
+            elif getattr(op, 'chunk_safe', False):
+                blocks.update(provides)
+            else:
+                raise ValueError("operation '%s' needs blocks of rows but is "
+                                 "neither chunk_safe nor has a reduce function" % op.name)
+            per_block.append(op)
+        elif needs & reduced:
+            reduced.update(provides)
+            after.append(op)
+        else:
+            before.append(op)
+
+    return before, per_block, after, blocks
+
+
+def compute_chunked(net, outputs, named_inputs, chunked, chunk_size, out=None, color=None):
+    """
+    Runs the network with the ``chunked`` inputs split into blocks of
+    ``chunk_size`` rows.  Execution times are recorded in the network's
+    ``times`` and ``stats``, once for every block.
+
+    :param net:
+        A compiled ``Network``, or a ``NetworkOperation`` created with
+        ``compose``.
+
+    :param list outputs:
+        The names of the data to return.  They must be listed, since
+        returning every intermediate array would defeat the purpose.
+
+    :param dict named_inputs:
+        The inputs, keyed by name, as for :meth:`Network.compute`.
+
+    :param list chunked:
+        The names of the inputs to split in blocks of rows.  They must all
+        have the same number of rows.
+
+    :param int chunk_size:
+        The number of rows in a block.
+
+    :param dict out:
+        Preallocated arrays (e.g. ``np.memmap`` files) to write outputs split
+        in blocks to, keyed by name.  Outputs split in blocks without one are
+        concatenated in memory.
+
+    :param str color:
+        Only the subgraph of nodes with color will be evaluted.
+
+    :returns: a dictionary of output data objects, keyed by name.
+    """
+    if isinstance(net, NetworkOperation):
+        net = net.net
+
+    assert net.steps, "network must be compiled before calling compute."
+    assert isinstance(outputs, (list, tuple)) and outputs, \
+        "The outputs of a chunked computation must be listed"
+    assert chunked, "no chunked inputs provided"
+    assert chunk_size > 0, "chunk_size must be positive"
+
+    missing = [name for name in chunked if name not in named_inputs]
+    if missing:
+        raise ValueError("chunked inputs %s were not provided" % missing)
+    lengths = set(len(named_inputs[name]) for name in chunked)
+    if len(lengths) != 1:
+        raise ValueError("chunked inputs must have the same number of rows")
+    rows = lengths.pop()
+    out = out or {}
+
+    named_inputs = net._add_constants(named_inputs)
+    steps = net._find_necessary_steps(outputs, named_inputs, color)
+    if any(isinstance(step, Control) for step in steps):
+        raise TypeError("Control flow operations can not be run in blocks of rows")
+    ops = [step for step in steps if isinstance(step, Operation)]
+    before, per_block, after, blocks = _split_phases(ops, chunked)
+
+    context = ExecutionContext({k: v for k, v in named_inputs.items() if k not in chunked}, None, color)
+    net._run_steps(before, context)
+
+    partials = {p.name: [] for op in per_block if getattr(op, 'reduce', None) is not None for p in op.provides}
+    pieces = {name: [] for name in outputs if name in blocks and name not in out}
+
+    for start in range(0, rows, chunk_size):
+        stop = min(start + chunk_size, rows)
+        block = ExecutionContext(dict(context.cache), None, color)
+        block.times = context.times
+        for name in chunked:
+            block.cache[name] = named_inputs[name][start:stop]
+
+        net._run_steps(per_block, block)
+
+        for name, values in partials.items():
+            values.append(block.cache[name])
+        for name in outputs:
+            if name in out and name in blocks:
+                out[name][start:stop] = block.cache[name]
+            elif name in pieces:
+                pieces[name].append(block.cache[name])
+
+    for op in per_block:
+        if getattr(op, 'reduce', None) is not None:
+            for p in op.provides:
+                context.cache[p.name] = op.reduce(partials[p.name])
+
+    net._run_steps(after, context)
+    net.times = context.times
+
+    results = {}
+    for name in outputs:
+        if name in out and name in blocks:
+            if hasattr(out[name], 'flush'):
+                out[name].flush()
+            results[name] = out[name]
+        elif name in pieces:
+            import numpy as np
+            results[name] = np.concatenate(pieces[name])
+        elif name in context.cache:
+            results[name] = context.cache[name]
+    return results
@@ -0,0 +1,175 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a cache of compilation results, keyed by the
+structural fingerprint of networks (see :meth:`Network.fingerprint`).  A
+network identical in structure to one compiled before reuses its steps and
+its execution plans instead of compiling again::
+
+    cache = CompileCache(directory='/var/cache/graphkit')
+    graph = compose(name='graph', compile_cache=cache)(*operations)
+
+Entries hold names only, never operations or functions, so they can be
+shared between processes through the cache directory.  The plans found by
+calls are written there in batches by a background thread, off the path of
+the calls.
+"""
+
+import os
+import atexit
+import pickle
+import weakref
+import tempfile
+import threading
+
+# the caches with a directory, whose new plans are written at exit; weak
+# references, so caches no longer used can be garbage collected.
+_open_caches = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_caches():
+    for cache in list(_open_caches):
+        cache.flush()
+
+
+class CompileCache(object):
+    """
+    Compilation results kept in memory and, optionally, in a directory.
+
+    :param str directory:
+        A directory to store entries in, one file per fingerprint.  Entries
+        found there are loaded when they are not in memory.
+
+    :param float flush_delay:
+        How long, in seconds, new plans are collected before the entries
+        holding them are written to the directory.  Plans not written yet
+        are written by :meth:`close`, or at exit.
+
+    :ivar int hits: The number of compilations served from the cache.
+    :ivar int misses: The number of compilations not found in the cache.
+    """
+
+    def __init__(self, directory=None, flush_delay=0.5):
+        self.directory = directory
+        self.flush_delay = flush_delay
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+        # the fingerprints of the entries with plans not written yet, the
+        # timer writing them, and a lock so writes of an entry don't overlap
+        self._dirty = set()
+        self._timer = None
+        self._write_lock = threading.Lock()
+        self._closed = False
+
+        if directory is not None:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            _open_caches.add(self)
+
+    def _path(self, fingerprint):
+        return os.path.join(self.directory, '%s.pickle' % fingerprint)
+
+    def get(self, fingerprint):
+        """
+        Returns the entry stored for ``fingerprint``: a dict with the
+        compiled ``steps``, as ``('op', name)`` or ``('del', name)`` tuples,
+        and the ``plans`` found so far, as lists of step indices keyed like
+        the plans of a network.  Returns ``None`` if there is none.
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is None and self.directory is not None:
+                try:
+                    with open(self._path(fingerprint), 'rb') as f:
+                        entry = self._entries[fingerprint] = pickle.load(f)
+                except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, fingerprint, steps):
+        """Stores the compiled steps of a network, forgetting its old plans."""
+        with self._write_lock:
+            with self._lock:
+                entry = self._entries[fingerprint] = {'steps': steps, 'plans': {}}
+                self._dirty.discard(fingerprint)
+                payload = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+            self._write(fingerprint, payload)
+
+    def put_plan(self, fingerprint, key, indices):
+        """
+        Adds an execution plan to the entry stored for ``fingerprint``.  It
+        is written to the directory later, along with the other new plans.
+        """
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None and key not in entry['plans']:
+                entry['plans'][key] = indices
+                if self.directory is not None and not self._closed:
+                    self._dirty.add(fingerprint)
+                    if self._timer is None:
+                        self._timer = threading.Timer(self.flush_delay, self._flush_later)
+                        self._timer.daemon = True
+                        self._timer.start()
+
+    def flush(self):
+        """Writes the entries with new plans to the directory now."""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                payloads = [(fingerprint, pickle.dumps(self._entries[fingerprint], pickle.HIGHEST_PROTOCOL))
+                            for fingerprint in self._dirty if fingerprint in self._entries]
+                self._dirty = set()
+            for fingerprint, payload in payloads:
+                self._write(fingerprint, payload)
+
+    def _flush_later(self):
+        try:
+            self.flush()
+        except OSError:
+            # e.g. the directory was removed meanwhile; the plans are still
+            # kept in memory, there's nobody to raise to from this thread.
+            pass
+
+    def close(self):
+        """
+        Writes the new plans to the directory and stops writing plans found
+        later, which are only kept in memory.
+        """
+        with self._lock:
+            self._closed = True
+        self.flush()
+        _open_caches.discard(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def clear(self):
+        """Forgets the entries kept in memory."""
+        with self._lock:
+            self._entries = {}
+
+    def _write(self, fingerprint, payload):
+        if self.directory is None:
+            return
+        # write to a temporary file first, so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp, self._path(fingerprint))
+        except BaseException:
+            os.unlink(tmp)
+            raise
@@ -0,0 +1,501 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains an executor that runs the operations of a compiled
+network on worker processes reachable over TCP or Unix sockets.
+
+Every worker keeps the data produced by the operations it ran.  Data is only
+shipped to another worker when an operation consuming it is scheduled there,
+in which case the consuming worker fetches it directly from the worker that
+holds it.  Several workers may be started on a single host with
+:class:`LocalCluster`::
+
+    from graphkit.distributed import LocalCluster, DistributedExecutor
+
+    with LocalCluster(4) as cluster:
+        executor = DistributedExecutor(cluster.addresses, authkey=cluster.authkey)
+        results = executor.compute(graph, ['e'], {'a': 1, 'b': 2})
+        executor.close()
+
+Operations are pickled to the workers, so their functions must be importable
+by name (e.g. module level functions rather than lambdas).
+"""
+
+import os
+import time
+import uuid
+import itertools
+import threading
+import multiprocessing
+
+from multiprocessing.connection import Listener, Client, wait
+
+from .base import Operation, NetworkOperation, Control
+from .network import check_output_types
+from .loaders import Loader
+
+
+class _Worker(object):
+    """
+    The state of a single worker process: the operations shipped to it,
+    keyed by ``(token, name)`` where ``token`` identifies the executor that
+    shipped them, and the data produced (or fetched) by it, keyed by
+    ``(call_id, name)``.
+    """
+
+    def __init__(self, address, authkey):
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.authkey = authkey
+        self.ops = {}
+        self.data = {}
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.stopped = False
+
+    def serve_forever(self):
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                # e.g. a client with a wrong authkey, which mustn't stop the worker
+                continue
+            if self.stopped:
+                conn.close()
+                break
+            thread = threading.Thread(target=self._handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+        self.listener.close()
+
+    def _stop(self):
+        # closing the listener does not interrupt a blocking accept(), so
+        # wake the serving thread up with a last connection instead.
+        self.stopped = True
+        Client(self.address, authkey=self.authkey).close()
+
+    def _fetch(self, call_id, name, address):
+        """Fetch the data ``name`` from the peer worker at ``address``."""
+        with self.lock:
+            if address not in self.peers:
+                self.peers[address] = (Client(address, authkey=self.authkey), threading.Lock())
+            conn, conn_lock = self.peers[address]
+        with conn_lock:
+            conn.send(('get', call_id, [name]))
+            status, payload = conn.recv()
+        if status != 'ok':
+            raise payload
+        return payload[name]
+
+    def _run(self, call_id, token, op_name, sources, values, drops):
+        for name in drops:
+            self.data.pop((call_id, name), None)
+        for name, value in values.items():
+            self.data[(call_id, name)] = value
+
+        fetched = list(values)
+        for name, address in sources.items():
+            self.data[(call_id, name)] = self._fetch(call_id, name, address)
+            fetched.append(name)
+
+        op = self.ops[(token, op_name)]
+        named_inputs = {}
+        for need in op.needs:
+            if (call_id, need.name) in self.data:
+                named_inputs[need.name] = self.data[(call_id, need.name)]
+
+        t0 = time.time()
+        layer_outputs = op._compute(named_inputs)
+        check_output_types(op, layer_outputs)
+        elapsed = round(time.time() - t0, 5)
+
+        for name, value in layer_outputs.items():
+            self.data[(call_id, name)] = value
+
+        return list(layer_outputs), fetched, elapsed
+
+    def _dispatch(self, message):
+        cmd = message[0]
+        if cmd == 'load':
+            token, ops = message[1:]
+            for op in ops:
+                self.ops[(token, op.name)] = op
+            return None
+        elif cmd == 'unload':
+            token = message[1]
+            for key in [k for k in self.ops if k[0] == token]:
+                self.ops.pop(key, None)
+            return None
+        elif cmd == 'run':
+            return self._run(*message[1:])
+        elif cmd == 'get':
+            call_id, names = message[1:]
+            return {name: self.data[(call_id, name)] for name in names}
+        elif cmd == 'release':
+            call_id = message[1]
+            for key in [k for k in self.data if k[0] == call_id]:
+                self.data.pop(key, None)
+            return None
+        elif cmd == 'shutdown':
+            self._stop()
+            return None
+        raise ValueError("Unrecognized worker command: %s" % cmd)
+
+    def _handle(self, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            try:
+                reply = ('ok', self._dispatch(message))
+            except Exception as e:
+                reply = ('error', e)
+            try:
+                conn.send(reply)
+            except Exception as e:
+                # the exception (or a result) could not be pickled
+                conn.send(('error', RuntimeError(repr(e))))
+            if message[0] == 'shutdown':
+                break
+        conn.close()
+
+
+def serve(address=None, authkey=None, ready=None):
+    """
+    Runs a worker in the current process until it receives a shutdown
+    command.
+
+    :param address:
+        The address to listen on, either a ``(host, port)`` tuple or the path
+        of a Unix socket.  Defaults to a free port on ``localhost``.
+
+    :param bytes authkey:
+        The key used to authenticate connections.  Workers execute pickled
+        operations, so this should always be set on shared networks.
+
+    :param ready:
+        An optional ``multiprocessing`` connection used to report the
+        address the worker is listening on once it is ready.
+    """
+    worker = _Worker(address or ('localhost', 0), authkey)
+    if ready is not None:
+        ready.send(worker.address)
+        ready.close()
+    worker.serve_forever()
+
+
+class LocalCluster(object):
+    """
+    Starts ``n`` worker processes on this host, each listening on its own
+    socket.  This is mostly useful for testing and for using every core of a
+    single machine.
+
+    :param int n:
+        The number of workers to start.
+
+    :param bytes authkey:
+        The key used to authenticate connections.  A random key is generated
+        if none is given.
+
+    :param list addresses:
+        Optional addresses (``(host, port)`` tuples or Unix socket paths) to
+        listen on, one per worker.
+    """
+
+    def __init__(self, n, authkey=None, addresses=None):
+        assert n > 0, "a cluster needs at least one worker"
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        addresses = addresses or [('localhost', 0)] * n
+        assert len(addresses) == n, "one address is needed per worker"
+
+        self.processes = []
+        self.addresses = []
+        for address in addresses:
+            receiver, sender = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=serve, args=(address, self.authkey, sender))
+            process.daemon = True
+            process.start()
+            sender.close()
+            self.addresses.append(receiver.recv())
+            receiver.close()
+            self.processes.append(process)
+
+    def close(self):
+        """Shuts down all the workers of this cluster."""
+        for address, process in zip(self.addresses, self.processes):
+            if not process.is_alive():
+                continue
+            try:
+                conn = Client(address, authkey=self.authkey)
+                conn.send(('shutdown',))
+                conn.recv()
+                conn.close()
+            except (OSError, EOFError):
+                pass
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class DistributedExecutor(object):
+    """
+    Runs the steps of a compiled network on a set of remote workers started
+    with :func:`serve` (or :class:`LocalCluster`).
+
+    Independent operations run concurrently on different workers, the ones
+    with the longest estimated path to the end of the graph first.  Every
+    intermediate value stays on the worker that produced it, and is only
+    transferred when an operation that consumes it is scheduled on another
+    worker.  Unless a ``placement`` is given, an operation is scheduled on the
+    idle worker already holding most of its inputs.
+
+    After each call, ``times`` holds the execution time of every operation,
+    ``placement`` maps every operation name to the index of the worker that
+    ran it, and ``transfers`` lists the ``(data name, source, destination)``
+    of every value that was shipped, with ``None`` denoting this process.
+
+    :param list addresses:
+        The addresses of the workers.
+
+    :param bytes authkey:
+        The key used to authenticate with the workers.
+    """
+
+    def __init__(self, addresses, authkey=None):
+        assert addresses, "at least one worker address is needed"
+        self.addresses = list(addresses)
+        self.authkey = authkey
+        self._conns = [Client(address, authkey=authkey) for address in self.addresses]
+        self._loaded = [{} for _ in self.addresses]
+        self._lock = threading.Lock()
+
+        # workers may be shared by several executors, in this process or
+        # others, so operations and calls are qualified by a unique token
+        self._token = uuid.uuid4().hex
+        self._call_ids = itertools.count()
+
+        self.times = {}
+        self.placement = {}
+        self.transfers = []
+
+    def close(self):
+        """Closes the connections to the workers, which forget the operations shipped."""
+        for conn in self._conns:
+            try:
+                conn.send(('unload', self._token))
+                conn.recv()
+            except (OSError, EOFError):
+                pass
+            conn.close()
+        self._conns = []
+
+    def _request(self, worker, message):
+        self._conns[worker].send(message)
+        return self._reply(worker)
+
+    def _reply(self, worker):
+        status, payload = self._conns[worker].recv()
+        if status != 'ok':
+            raise payload
+        return payload
+
+    def _load(self, worker, ops):
+        """Ships the operations a worker does not already have."""
+        loaded = self._loaded[worker]
+        missing = [op for op in ops if loaded.get(op.name) is not op]
+        if missing:
+            self._request(worker, ('load', self._token, missing))
+            loaded.update((op.name, op) for op in missing)
+
+    def compute(self, net, outputs, named_inputs, color=None, placement=None):
+        """
+        Runs the network on the workers.  The arguments and the return value
+        are the same as for :meth:`Network.compute`.
+
+        :param net:
+            A compiled ``Network``, or a ``NetworkOperation`` created with
+            ``compose``.
+
+        :param dict placement:
+            An optional mapping of operation names to worker indices (as
+            produced by :mod:`graphkit.partition`).  Operations missing from
+            it are placed by data locality.
+        """
+        if isinstance(net, NetworkOperation):
+            net = net.net
+
+        assert net.steps, "network must be compiled before calling compute."
+        assert isinstance(outputs, (list, tuple)) or outputs is None,\
+            "The outputs argument must be a list"
+
+        hidden = net._hidden_inputs(named_inputs)
+        named_inputs = net._add_constants(named_inputs)
+        with self._lock:
+            return self._compute(net, outputs, named_inputs, color, placement or {}, hidden)
+
+    def _compute(self, net, outputs, named_inputs, color, placement, hidden):
+        all_steps = net._find_necessary_steps(outputs, named_inputs, color)
+        if any(isinstance(step, Control) for step in all_steps):
+            raise TypeError("Control flow operations can not be run by the DistributedExecutor")
+        ops = [step for step in all_steps if isinstance(step, Operation)]
+        priority = net._remaining_path_lengths()
+
+        for worker in range(len(self._conns)):
+            self._load(worker, ops)
+
+        producers = {}
+        for op in ops:
+            for p in op.provides:
+                producers[p.name] = op
+
+        # operations waiting on other operations, and consumer counts used to
+        # drop data from the workers as soon as it is no longer needed.
+        waiting_on = {}
+        consumers = {}
+        remaining = {}
+        for op in ops:
+            deps = set(producers[n.name] for n in op.needs
+                       if n.name in producers and producers[n.name] is not op)
+            waiting_on[op] = deps
+            for dep in deps:
+                consumers.setdefault(dep, []).append(op)
+            for n in op.needs:
+                remaining[n.name] = remaining.get(n.name, 0) + 1
+
+        keep = set(outputs) if outputs else None
+        call_id = (self._token, next(self._call_ids))
+        location = {}
+        drops = [[] for _ in self._conns]
+        ready = [op for op in ops if not waiting_on[op]]
+        idle = set(range(len(self._conns)))
+        inflight = {}
+
+        self.times = {}
+        self.placement = {}
+        self.transfers = []
+        failure = None
+
+        try:
+            while (ready or inflight) and failure is None:
+
+                # dispatch as many ready operations as there are idle workers,
+                # starting with the ones on the critical path
+                ready.sort(key=lambda op: -priority[op])
+                for op in list(ready):
+                    if not idle:
+                        break
+                    worker = self._choose_worker(op, idle, location, placement)
+                    if worker is None:
+                        continue
+
+                    sources, values = {}, {}
+                    for name in set(n.name for n in op.needs):
+                        holders = location.get(name)
+                        if not holders:
+                            if name in named_inputs:
+                                value = named_inputs[name]
+                                values[name] = value.resolve() if isinstance(value, Loader) else value
+                                self.transfers.append((name, None, worker))
+                        elif worker not in holders:
+                            source = min(holders)
+                            sources[name] = self.addresses[source]
+                            self.transfers.append((name, source, worker))
+
+                    self._conns[worker].send(('run', call_id, self._token, op.name, sources, values, drops[worker]))
+                    drops[worker] = []
+                    ready.remove(op)
+                    idle.discard(worker)
+                    inflight[self._conns[worker]] = (worker, op)
+                    self.placement[op.name] = worker
+
+                if not inflight:
+                    raise ValueError("No worker available for operations %s" % [op.name for op in ready])
+
+                for conn in wait(list(inflight)):
+                    worker, op = inflight.pop(conn)
+                    idle.add(worker)
+                    try:
+                        provided, fetched, elapsed = self._reply(worker)
+                    except Exception as e:
+                        failure = failure or e
+                        continue
+
+                    self.times[op.name] = elapsed
+                    net._record_time(op.name, elapsed)
+                    for name in provided:
+                        location[name] = {worker}
+                    for name in fetched:
+                        location.setdefault(name, set()).add(worker)
+
+                    for n in op.needs:
+                        remaining[n.name] -= 1
+                        if remaining[n.name] == 0 and keep is not None and n.name not in keep \
+                                and n.name not in named_inputs:
+                            for holder in location.get(n.name, ()):
+                                drops[holder].append(n.name)
+
+                    for consumer in consumers.get(op, ()):
+                        waiting_on[consumer].discard(op)
+                        if not waiting_on[consumer]:
+                            ready.append(consumer)
+
+            # wait for operations still running after a failure
+            for conn, (worker, op) in list(inflight.items()):
+                try:
+                    self._reply(worker)
+                except Exception:
+                    pass
+            if failure is not None:
+                raise failure
+
+            return self._collect(call_id, outputs, named_inputs, location, hidden)
+
+        finally:
+            for worker in range(len(self._conns)):
+                self._request(worker, ('release', call_id))
+
+    def _choose_worker(self, op, idle, location, placement):
+        """
+        Picks the worker that should run ``op``, or ``None`` if the worker it
+        is placed on is busy.
+        """
+        if op.name in placement:
+            worker = placement[op.name] % len(self._conns)
+            return worker if worker in idle else None
+
+        def local_inputs(worker):
+            return sum(1 for n in op.needs if worker in location.get(n.name, ()))
+
+        return max(sorted(idle), key=local_inputs)
+
+    def _collect(self, call_id, outputs, named_inputs, location, hidden):
+        """
+        Fetches the requested outputs back from the workers holding them.
+        Without outputs, all the data computed is returned, but not the
+        ``hidden`` inputs.
+        """
+        if outputs:
+            names = [name for name in outputs if name in location or name in named_inputs]
+        else:
+            names = [name for name, holders in location.items() if holders and name not in hidden]
+            names += [name for name in named_inputs if name not in hidden and not location.get(name)]
+
+        results = {}
+        by_worker = {}
+        for name in names:
+            if location.get(name):
+                by_worker.setdefault(min(location[name]), []).append(name)
+            else:
+                value = named_inputs[name]
+                results[name] = value.resolve() if isinstance(value, Loader) else value
+        for worker, worker_names in by_worker.items():
+            results.update(self._request(worker, ('get', call_id, worker_names)))
+        return results
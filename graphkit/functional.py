@@ -2,6 +2,7 @@
 # Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
 
 from itertools import chain
+from collections import OrderedDict
 
 from .base import Operation, NetworkOperation, Var
 from .network import Network
@@ -40,7 +41,6 @@ class FunctionalOperation(Operation):
     def __getstate__(self):
         state = Operation.__getstate__(self)
         state['fn'] = self.__dict__['fn']
-        state['color'] = self.__dict__['color']
         return state
 
 
@@ -72,6 +72,39 @@ class operation(Operation):
 
     :param str color:
         A color for the node in the computation graph.
+
+    :param bool chunk_safe:
+        Declares that ``fn`` works row by row, so that it can be run on
+        blocks of rows of its inputs by :func:`graphkit.chunked.compute_chunked`.
+
+    :param function reduce:
+        Declares that ``fn`` can be run on blocks of rows, and that its
+        results for all blocks are combined by calling ``reduce`` with the
+        list of them, e.g. ``sum`` for a ``fn`` returning partial sums.
+
+    :param bool batched:
+        Declares that ``fn`` can run on the inputs of many calls stacked
+        along a new first axis, returning its outputs stacked the same way,
+        so :class:`graphkit.batching.MicroBatcher` calls it once per batch.
+
+    :param bool io_bound:
+        Declares that ``fn`` mostly waits on I/O (a database query, a remote
+        call...).  ``compute`` starts it on a background thread as soon as
+        its needs are available and joins it when its step is reached, while
+        the operations in between keep running in order.
+
+    :param dict resources:
+        The amount of every resource ``fn`` holds while it runs, e.g.
+        ``{'mem_gb': 4, 'db': 1}``.  A :class:`graphkit.scheduler.ParallelScheduler`
+        given the capacity of these resources never runs operations holding
+        more than that at once.
+
+    :param bool stream:
+        Declares that ``fn`` streams: its outputs that are iterators, e.g.
+        when ``fn`` is a generator function, are passed lazily to a single
+        consumer, and the streams it needs are passed to it as iterators
+        rather than lists, so that it pulls their items one at a time.  See
+        :mod:`graphkit.streaming`.
     """
 
     def __init__(self, fn=None, **kwargs):
@@ -184,12 +217,50 @@ class compose(object):
         this ``compose`` instance).  If any two operations are the same
         (based on name), then that operation is computed only once, instead
         of multiple times (one for each time the operation appears).
+
+    :param bool cse:
+        If ``True``, operations that are structurally identical to another
+        one (same function, needs, params and color, under a different name)
+        are computed only once and their provides aliased, see
+        :meth:`Network.eliminate_common_subexpressions`.  What was merged is
+        reported in the ``cse_merges`` of the resulting graph's network.
+
+    :param dict constants:
+        Values of inputs that never change, keyed by name.  Operations that
+        depend only on them are evaluated once, when composing, and the
+        resulting graph no longer needs these inputs, see
+        :meth:`Network.bind`.
+
+    :param coalesce:
+        If ``True``, concurrent calls of the resulting graph with equal
+        inputs, outputs and color share one execution: the calls made while
+        the first one is running wait for it, and receive a copy of its
+        result or its exception.  Inputs are compared by value (arrays by
+        contents).  A function of ``(named_inputs, outputs, color)``
+        returning a hashable key (or ``None`` to not coalesce a call) can be
+        given instead, see :func:`graphkit.singleflight.fingerprint`.
+
+    :param fuse:
+        If ``True``, or a list of data names to keep visible, linear chains
+        of operations are merged into single steps to save per-step
+        overhead, see :meth:`Network.fuse_chains`.  The data inside the
+        chains (but not in the list) can no longer be requested as outputs.
+
+    :param CompileCache compile_cache:
+        A :class:`graphkit.compile_cache.CompileCache` to reuse the compiled
+        steps and plans of a structurally identical graph from.
     """
 
-    def __init__(self, name=None, merge=False):
+    def __init__(self, name=None, merge=False, cse=False, constants=None, coalesce=False, fuse=False,
+                 compile_cache=None):
         assert name, "compose needs a name"
         self.name = name
         self.merge = merge
+        self.cse = cse
+        self.constants = constants
+        self.coalesce = coalesce
+        self.fuse = fuse
+        self.compile_cache = compile_cache
 
     def __call__(self, *operations):
         """
@@ -208,14 +279,15 @@ class compose(object):
 
         # If merge is desired, deduplicate operations before building network
         if self.merge:
-            merge_set = set()
+            merged = OrderedDict()
             for op in operations:
                 if isinstance(op, NetworkOperation):
-                    net_ops = filter(lambda x: isinstance(x, Operation), op.net.steps)
-                    merge_set.update(net_ops)
+                    for step in op.net.steps:
+                        if isinstance(step, Operation):
+                            merged.setdefault(step, step)
                 else:
-                    merge_set.add(op)
-            operations = list(merge_set)
+                    merged.setdefault(op, op)
+            operations = list(merged)
 
         def order_preserving_uniquifier(seq, seen=None):
             seen = seen if seen else set()
@@ -227,8 +299,17 @@ class compose(object):
 
         # compile network
         net = Network()
-        for op in operations:
-            net.add_op(op)
-        net.compile()
-
-        return NetworkOperation(name=self.name, needs=needs, provides=provides, params={}, net=net)
+        net.add_ops(operations)
+        if self.cse:
+            net.eliminate_common_subexpressions()
+        if self.fuse:
+            net.fuse_chains(() if self.fuse is True else self.fuse)
+            provides = [p for p in provides if net.graph.has_node(p.name)]
+        net.compile(cache=self.compile_cache)
+
+        if self.constants:
+            net = net.bind(self.constants)
+            needs = [n for n in needs if n.name not in net.constants]
+
+        return NetworkOperation(name=self.name, needs=needs, provides=provides, params={}, net=net,
+                                coalesce=self.coalesce)
@@ -0,0 +1,98 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains deferred inputs: an input value wrapped in a
+:class:`Loader` is only fetched when the first operation needing it is
+about to run, so inputs the requested outputs don't depend on are never
+fetched::
+
+    graph({'user': user_id, 'history': Loader(lambda: fetch_history(user_id))},
+          outputs=['score'])
+
+When an operation needs several inputs that are still deferred, they are
+fetched concurrently.
+"""
+
+import asyncio
+import inspect
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class Loader(object):
+    """
+    A deferred input value.  It is fetched at most once, even when several
+    threads ask for it, and a failure is raised to all of them.
+
+    :param source:
+        A callable taking no arguments, a ``concurrent.futures.Future``, or
+        an awaitable (e.g. a coroutine), which is run on an event loop of
+        its own, in a thread of its own, so that ``compute`` can be called
+        from async code.  Awaitables bound to an event loop, such as
+        ``asyncio`` tasks, can't be run there and are refused.
+    """
+
+    def __init__(self, source):
+        if isinstance(source, asyncio.Future):
+            raise TypeError("asyncio futures and tasks are bound to their event loop; "
+                            "wrap the coroutine itself in a Loader")
+        self.source = source
+        self._lock = threading.Lock()
+        self._done = False
+        self._value = None
+        self._error = None
+
+    def resolve(self):
+        """Returns the value, fetching it if that was not done yet."""
+        with self._lock:
+            if not self._done:
+                try:
+                    self._value = self._fetch()
+                except Exception as e:
+                    self._error = e
+                self._done = True
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+    def _fetch(self):
+        source = self.source
+        if isinstance(source, Future):
+            return source.result()
+        if inspect.isawaitable(source):
+            async def wait():
+                return await source
+            # asyncio.run can't be called from a thread running a loop
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                return pool.submit(asyncio.run, wait()).result()
+        return source()
+
+    def __repr__(self):
+        return u"Loader(source=%r, resolved=%s)" % (self.source, self._done)
+
+
+def deferred_names(named_inputs):
+    """Returns the set of input names whose value is a :class:`Loader`."""
+    return set(name for name, value in named_inputs.items() if isinstance(value, Loader))
+
+
+def resolve_loaders(names, cache, pending):
+    """
+    Replaces, in ``cache``, the loaders among the data ``names`` with their
+    values, fetching several of them concurrently.  ``pending`` is the set
+    of names still deferred, and is updated.
+    """
+    names = [name for name in names if name in pending]
+    if not names:
+        return
+
+    if len(names) == 1:
+        values = [cache[names[0]].resolve()]
+    else:
+        with ThreadPoolExecutor(max_workers=len(names)) as pool:
+            values = list(pool.map(lambda name: cache[name].resolve(), names))
+
+    for name, value in zip(names, values):
+        cache[name] = value
+        pending.discard(name)
@@ -0,0 +1,114 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains the memory accounting of ``Network.compute``: the
+estimated size of every data node, the size of the live data cache after
+every step, and which data were alive when it peaked::
+
+    report = MemoryReport()
+    graph(inputs, outputs=['y'], memory=report)
+    print(report)
+"""
+
+import sys
+import tracemalloc as _tracemalloc
+
+
+def sizeof(value):
+    """
+    Estimates the size in bytes of a value: arrays are measured with their
+    ``nbytes`` attribute, other objects with ``sys.getsizeof``.
+    """
+    nbytes = getattr(value, 'nbytes', None)
+    return nbytes if isinstance(nbytes, int) else sys.getsizeof(value)
+
+
+class MemoryReport(object):
+    """
+    Collects the memory accounting of one call to ``Network.compute``.
+
+    :param bool tracemalloc:
+        Also record how much the memory traced by :mod:`tracemalloc` grew
+        while running each operation.  Tracing is started for the call if
+        it is not already on, and slows execution down noticeably.
+
+    :ivar dict sizes:
+        The estimated size of every input and computed data, keyed by name.
+
+    :ivar list timeline:
+        A ``(step, live_bytes)`` tuple after the inputs were loaded (step
+        ``None``), after every operation (its name) and after every data
+        deletion (``'del <name>'``).
+
+    :ivar dict allocated:
+        The growth of traced memory while running each operation, keyed by
+        name, when ``tracemalloc`` is on.
+
+    :ivar int peak_bytes:
+        The largest size of the live data cache.
+
+    :ivar peak_step:
+        The step after which the peak was reached.
+
+    :ivar list peak_alive:
+        ``(name, size)`` of the data alive at the peak, largest first.
+    """
+
+    def __init__(self, tracemalloc=False):
+        self.tracemalloc = tracemalloc
+        self.sizes = {}
+        self.timeline = []
+        self.allocated = {}
+        self.peak_bytes = 0
+        self.peak_step = None
+        self.peak_alive = []
+        self._live = {}
+        self._live_bytes = 0
+        self._traced = None
+        self._started_tracing = False
+
+    def _start(self, cache):
+        if self.tracemalloc and not _tracemalloc.is_tracing():
+            _tracemalloc.start()
+            self._started_tracing = True
+        for name, value in cache.items():
+            self._add(name, value)
+        self._record(None)
+
+    def _stop(self):
+        if self._started_tracing:
+            _tracemalloc.stop()
+            self._started_tracing = False
+
+    def _before_op(self, op):
+        if self.tracemalloc:
+            self._traced = _tracemalloc.get_traced_memory()[0]
+
+    def _after_op(self, op, layer_outputs):
+        if self.tracemalloc:
+            self.allocated[op.name] = _tracemalloc.get_traced_memory()[0] - self._traced
+        for name, value in layer_outputs.items():
+            self._add(name, value)
+        self._record(op.name)
+
+    def _after_delete(self, name):
+        self._live_bytes -= self._live.pop(name, 0)
+        self._record('del %s' % name)
+
+    def _add(self, name, value):
+        size = sizeof(value)
+        self.sizes[name] = size
+        self._live_bytes += size - self._live.get(name, 0)
+        self._live[name] = size
+
+    def _record(self, step):
+        self.timeline.append((step, self._live_bytes))
+        if len(self.timeline) == 1 or self._live_bytes > self.peak_bytes:
+            self.peak_bytes = self._live_bytes
+            self.peak_step = step
+            self.peak_alive = sorted(self._live.items(), key=lambda item: -item[1])
+
+    def __repr__(self):
+        alive = ", ".join("%s=%d" % item for item in self.peak_alive)
+        return u"MemoryReport(peak_bytes=%d, peak_step=%s, alive=[%s])" % \
+            (self.peak_bytes, self.peak_step, alive)
@@ -0,0 +1,208 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a registry of metrics aggregated over all calls to
+a network: latency histograms, call and error counts of every operation,
+and the hit rate of the plan cache.  They can be rendered in the Prometheus
+text format, or served over HTTP for scraping::
+
+    from graphkit.metrics import MetricsRegistry, start_http_server
+
+    registry = MetricsRegistry()
+    registry.attach(graph)
+    server = start_http_server(registry, port=9100)
+
+Every thread updates counters of its own, without locks; they are only
+summed up when the metrics are read.
+"""
+
+import bisect
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .base import NetworkOperation
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _OperationCounters(object):
+    """The counters of one operation in one thread."""
+
+    def __init__(self, n_buckets):
+        self.buckets = [0] * (n_buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+
+class _Shard(object):
+    """The counters updated by one thread."""
+
+    def __init__(self):
+        self.operations = {}
+        self.calls = 0
+        self.plan_hits = 0
+        self.plan_misses = 0
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsRegistry(object):
+    """
+    Aggregates the metrics of the networks it is attached to.
+
+    :param tuple buckets:
+        The upper bounds, in seconds, of the latency histogram buckets.
+
+    :param str namespace:
+        The prefix of the exported metric names.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, namespace='graphkit'):
+        self.buckets = tuple(sorted(buckets))
+        self.namespace = namespace
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+
+    def attach(self, net):
+        """
+        Starts recording the metrics of a ``Network``, or of the network of
+        a ``NetworkOperation`` created with ``compose``.
+        """
+        if isinstance(net, NetworkOperation):
+            net = net.net
+        net.metrics = self
+        return self
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard()
+            with self._shards_lock:
+                self._shards.append(shard)
+        return shard
+
+    def _counters(self, shard, name):
+        counters = shard.operations.get(name)
+        if counters is None:
+            counters = shard.operations[name] = _OperationCounters(len(self.buckets))
+        return counters
+
+    def observe(self, name, seconds):
+        """Records one execution of the operation ``name``."""
+        counters = self._counters(self._shard(), name)
+        counters.buckets[bisect.bisect_left(self.buckets, seconds)] += 1
+        counters.sum += seconds
+        counters.count += 1
+
+    def error(self, name):
+        """Records one failed execution of the operation ``name``."""
+        self._counters(self._shard(), name).errors += 1
+
+    def call(self):
+        """Records one call to ``compute``."""
+        self._shard().calls += 1
+
+    def plan_lookup(self, hit):
+        """Records one lookup in the plan cache."""
+        shard = self._shard()
+        if hit:
+            shard.plan_hits += 1
+        else:
+            shard.plan_misses += 1
+
+    def snapshot(self):
+        """
+        Returns the metrics summed over all threads: a dict with ``calls``,
+        ``plan_hits``, ``plan_misses`` and ``operations``, which maps every
+        operation name to a dict with its cumulative ``buckets`` counts,
+        ``sum``, ``count`` and ``errors``.
+        """
+        with self._shards_lock:
+            shards = list(self._shards)
+
+        result = {'calls': 0, 'plan_hits': 0, 'plan_misses': 0, 'operations': {}}
+        for shard in shards:
+            result['calls'] += shard.calls
+            result['plan_hits'] += shard.plan_hits
+            result['plan_misses'] += shard.plan_misses
+            for name, counters in list(shard.operations.items()):
+                total = result['operations'].setdefault(
+                    name, {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'errors': 0})
+                for i, n in enumerate(counters.buckets):
+                    total['buckets'][i] += n
+                total['sum'] += counters.sum
+                total['count'] += counters.count
+                total['errors'] += counters.errors
+
+        for total in result['operations'].values():
+            for i in range(1, len(total['buckets'])):
+                total['buckets'][i] += total['buckets'][i - 1]
+        return result
+
+    def render_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        snapshot = self.snapshot()
+        ns = self.namespace
+        lines = []
+
+        def header(name, kind, text):
+            lines.append("# HELP %s_%s %s" % (ns, name, text))
+            lines.append("# TYPE %s_%s %s" % (ns, name, kind))
+
+        header('operation_duration_seconds', 'histogram', 'Execution time of operations.')
+        for name, total in sorted(snapshot['operations'].items()):
+            label = 'operation="%s"' % _escape(name)
+            bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+            for bound, n in zip(bounds, total['buckets']):
+                lines.append('%s_operation_duration_seconds_bucket{%s,le="%s"} %d' % (ns, label, bound, n))
+            lines.append('%s_operation_duration_seconds_sum{%s} %r' % (ns, label, total['sum']))
+            lines.append('%s_operation_duration_seconds_count{%s} %d' % (ns, label, total['count']))
+
+        header('operation_errors_total', 'counter', 'Failed executions of operations.')
+        for name, total in sorted(snapshot['operations'].items()):
+            lines.append('%s_operation_errors_total{operation="%s"} %d' % (ns, _escape(name), total['errors']))
+
+        for key, text in [('calls', 'Calls to compute.'),
+                          ('plan_hits', 'Plan cache hits.'),
+                          ('plan_misses', 'Plan cache misses.')]:
+            header('%s_total' % key, 'counter', text)
+            lines.append('%s_%s_total %d' % (ns, key, snapshot[key]))
+
+        return "\n".join(lines) + "\n"
+
+
+def start_http_server(registry, port=0, host='127.0.0.1'):
+    """
+    Serves the metrics of ``registry`` at ``http://host:port/metrics`` from
+    a daemon thread.  Returns the server; its ``server_address`` holds the
+    actual port, and ``shutdown()`` stops it.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
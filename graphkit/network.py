@@ -3,11 +3,24 @@
 
 import time
 import os
+import heapq
+import hashlib
+import threading
 import networkx as nx
 
 from io import StringIO
+from itertools import chain
+from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
-from .base import Operation, NetworkOperation, Control
+from .base import Operation, NetworkOperation, Control, AliasOperation, FusedOperation, Var
+from .base import check_output_types
+from .stats import LatencyStats
+from .memory import MemoryReport
+from .loaders import Loader, deferred_names, resolve_loaders
+from .streaming import stream_consumers, keep_streams, feed_streams
+from .checkpoint import Checkpoint, resume, _step_key
 
 
 class DataPlaceholderNode(str):
@@ -15,6 +28,8 @@ class DataPlaceholderNode(str):
     A node for the Network graph that describes the name of a Data instance
     produced or required by a layer.
     """
+    __slots__ = ()
+
     def __repr__(self):
         return 'DataPlaceholderNode("%s")' % self
 
@@ -24,10 +39,162 @@ class DeleteInstruction(str):
     An instruction for the compiled list of evaluation steps to free or delete
     a Data instance from the Network's cache after it is no longer needed.
     """
+    __slots__ = ()
+
     def __repr__(self):
         return 'DeleteInstruction("%s")' % self
 
 
+def _same_params(params, other):
+    """Compares the params of two layers, treating uncomparable ones as different."""
+    try:
+        return bool(params == other)
+    except Exception:
+        return False
+
+
+def _walk(adjacency, sources):
+    """
+    Returns the nodes reachable from the ``sources`` through ``adjacency``
+    (the ``_succ`` or ``_pred`` of a graph), not counting the sources.  Data
+    nodes are keyed by name, layers by their integer ``id``, which avoids
+    calling the ``__hash__`` of layers for every node visited.
+    """
+    reached = {}
+    stack = list(sources)
+    while stack:
+        for node in adjacency[stack.pop()]:
+            key = node if isinstance(node, str) else id(node)
+            if key not in reached:
+                reached[key] = node
+                stack.append(node)
+    return reached
+
+
+def _lexicographical_topological_sort(graph, key):
+    """
+    Returns the nodes of ``graph`` in topological order, breaking ties by
+    ``key`` and then by the order in which nodes were added to the graph.
+    This is the order given by ``nx.lexicographical_topological_sort``,
+    computed with less overhead per node.
+    """
+    index = {node: i for i, node in enumerate(graph)}
+    succ = graph.succ
+    indegree = {}
+    ready = []
+    for node, degree in graph.in_degree():
+        if degree:
+            indegree[node] = degree
+        else:
+            ready.append((key(node), index[node], node))
+    heapq.heapify(ready)
+
+    ordered = []
+    while ready:
+        node = heapq.heappop(ready)[2]
+        ordered.append(node)
+        for child in succ[node]:
+            indegree[child] -= 1
+            if not indegree[child]:
+                del indegree[child]
+                heapq.heappush(ready, (key(child), index[child], child))
+
+    if indegree:
+        raise nx.NetworkXUnfeasible("Graph contains a cycle or graph changed during iteration")
+    return ordered
+
+
+def _timed_prefetch(op, inputs):
+    """Computes an operation started in the background, and times it."""
+    inputs = {name: value.resolve() if isinstance(value, Loader) else value
+              for name, value in inputs.items()}
+    t0 = time.time()
+    return op._compute(inputs), time.time() - t0
+
+
+class ExecutionContext(object):
+    """
+    The state of a single call running the steps of a network: the data
+    cache, the requested outputs and color, the execution time of every layer
+    run and an optional :class:`MemoryReport`.  Keeping it out of the ``Network`` lets many threads compute
+    with the same compiled network at once.
+    """
+
+    def __init__(self, cache, outputs=None, color=None, memory=None):
+        self.cache = cache
+        self.outputs = outputs
+        self.color = color
+        self.memory = memory
+        self.times = {}
+
+        # the names of inputs still deferred by a Loader
+        self.deferred = deferred_names(cache)
+
+        # the names of data kept as iterators for their single consumer, the
+        # steps run and, once needed, the number of consumers of their data
+        self.streams = set()
+        self.steps = None
+        self.consumers = None
+
+        # an optional Checkpoint, the keys of all the steps of the plan and,
+        # when resuming, the number of them done before and whether the
+        # branch of an if/else chain was taken
+        self.checkpoint = None
+        self.plan = None
+        self.resumed = 0
+        self.if_true = False
+
+
+class LazyResults(Mapping):
+    """
+    The read-only mapping returned by ``Network.compute(..., lazy=True)``.
+    Accessing a key runs only the steps needed to compute it from the inputs
+    and the data computed by earlier accesses, which are kept for later ones.
+    """
+
+    def __init__(self, net, outputs, named_inputs, color=None, hidden=None):
+        self._net = net
+        self._inputs = named_inputs
+        self._context = ExecutionContext(dict(named_inputs), None, color)
+        self._cache = self._context.cache
+
+        if outputs:
+            self._keys = list(outputs)
+        else:
+            # all data computable from the inputs, excluding the inputs.
+            hidden = set(named_inputs) if hidden is None else hidden
+            steps = net._find_necessary_steps(outputs, named_inputs, color)
+            keys = [k for k in named_inputs if k in net.folded] + \
+                [p.name for step in steps if isinstance(step, Operation) for p in step.provides]
+            self._keys = [k for k in OrderedDict.fromkeys(keys) if k not in hidden]
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        if key not in self._cache:
+            # plan from the inputs, so there's one plan per key, then skip
+            # the layers whose outputs earlier accesses computed
+            cache = self._cache
+            steps = self._net._find_necessary_steps([key], self._inputs, self._context.color)
+            steps = [step for step in steps if not isinstance(step, Operation) or
+                     not all(p.name in cache for p in step.provides)]
+            self._net._run_steps(steps, self._context)
+        return self._cache[key]
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        computed = [k for k in self._keys if k in self._cache]
+        return u"LazyResults(keys=%s, computed=%s)" % (self._keys, computed)
+
+
 class Network(object):
     """
     This is the main network implementation. The class contains all of the
@@ -43,17 +210,63 @@ class Network(object):
         self.graph = nx.DiGraph()
         self._debug = kwargs.get("debug", False)
 
-        # this holds the timing information for eache layer
+        # this holds the timing information for eache layer, as measured by
+        # the last call to finish.
         self.times = {}
 
+        # the memory accounting of the last call to finish that asked for it.
+        self.memory_report = None
+
+        # an optional registry aggregating metrics over all calls, see
+        # graphkit.metrics.
+        self.metrics = None
+
+        # the layers replaced by an alias of a structurally identical layer,
+        # mapping their name to the name of the layer kept.
+        self.cse_merges = {}
+
+        # the layers running linear chains of layers, mapping their name to
+        # the names of the layers in the chain.
+        self.fused_chains = {}
+
+        # values bound at compile time, added to the inputs of every call,
+        # and the names of those computed by layers evaluated at that time,
+        # which calls return like other computed data.
+        self.constants = {}
+        self.folded = set()
+
+        # rolling latency statistics for each layer, kept across calls.
+        self.stats = {}
+        self._stats_alpha = kwargs.get("stats_alpha", 0.2)
+        self._stats_window = kwargs.get("stats_window", 100)
+
         # a compiled list of steps to evaluate layers *in order* and free mem.
         self.steps = []
 
         # This holds a cache of results for the _find_necessary_steps
         # function, this helps speed up the compute call as well avoid
         # a multithreading issue that is occuring when accessing the
-        # graph in networkx
+        # graph in networkx.  Lookups are lock free, misses are computed
+        # under the lock so the graph is walked by one thread at a time.
         self._necessary_steps_cache = {}
+        self._plan_lock = threading.Lock()
+
+        # the CompileCache the steps were compiled with, and the fingerprint
+        # they are stored under there, while the graph is left unchanged.
+        self._compile_cache = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_plan_lock']
+        state['metrics'] = None
+        state['_compile_cache'] = None
+        return state
+
+    def __setstate__(self, state):
+        # start from the defaults, for the attributes added since older
+        # networks were pickled; the plan lock is never pickled.
+        self.__init__()
+        self.__dict__.update(state)
 
     def add_op(self, operation):
         """
@@ -63,44 +276,567 @@ class Network(object):
 
         :param Operation operation: Operation object to add.
         """
+        self.add_ops([operation])
+
+    def add_ops(self, operations):
+        """
+        Adds many operations to the network graph at once.  All operations are
+        validated in a single pass before the graph is modified, so either all
+        of them are added or none is.
+
+        :param operations: An iterable of Operation objects to add.
+        """
+        operations = list(operations)
+        graph = self.graph
 
-        # assert layer and its data requirements are named.
-        assert operation.name, "Operation must be named"
-        assert operation.needs is not None, "Operation's 'needs' must be named"
-        assert operation.provides is not None, "Operation's 'provides' must be named"
+        # one node object per data name, instead of one per edge
+        data_nodes = {}
 
-        # assert layer is only added once to graph
-        assert operation not in self.graph.nodes(), "Operation may only be added once"
+        def data_node(name):
+            node = data_nodes.get(name)
+            if node is None:
+                node = data_nodes[name] = DataPlaceholderNode(name)
+            return node
 
-        # add nodes and edges to graph describing the data needs for this layer
-        for n in operation.needs:
-            self.graph.add_edge(DataPlaceholderNode(n.name), operation)
+        names = set()
+        types = {}
+        edges = []
+        for operation in operations:
 
-            if 'type' not in self.graph.nodes[n.name]:
-                self.graph.nodes[n.name]['type'] = n.type
-            elif self.graph.nodes[n.name]['type'] != n.type:
-                raise TypeError("Duplicate nodes with different types. Needs: %s Expected: %s Got: %s" %
-                                (n.name, self.graph.nodes[n.name]['type'], n.type))
+            # assert layer and its data requirements are named.
+            assert operation.name, "Operation must be named"
+            assert operation.needs is not None, "Operation's 'needs' must be named"
+            assert operation.provides is not None, "Operation's 'provides' must be named"
 
-        # add nodes and edges to graph describing what this layer provides
-        for p in operation.provides:
-            self.graph.add_edge(operation, DataPlaceholderNode(p.name))
+            # assert layer is only added once to graph
+            assert operation not in names and operation not in graph, "Operation may only be added once"
+            names.add(operation)
 
-            if 'type' not in self.graph.nodes[p.name]:
-                self.graph.nodes[p.name]['type'] = p.type
-            elif self.graph.nodes[p.name]['type'] != p.type:
-                raise TypeError("Duplicate nodes with different types. Provides: %s Expected: %s Got: %s" %
-                                (p.name, self.graph.nodes[p.name]['type'], p.type))
+            # edges describing the data needs for this layer, and what it provides
+            for n in operation.needs:
+                self._check_type(types, n, "Needs")
+                edges.append((data_node(n.name), operation))
 
-        if operation.color:
-            self.graph.nodes[operation]['color'] = operation.color
+            for p in operation.provides:
+                self._check_type(types, p, "Provides")
+                edges.append((operation, data_node(p.name)))
 
-        if isinstance(operation, Control) and hasattr(operation, 'condition_needs'):
-            for n in operation.condition_needs:
-                self.graph.add_edge(DataPlaceholderNode(n), operation)
+            if isinstance(operation, Control) and hasattr(operation, 'condition_needs'):
+                for n in operation.condition_needs:
+                    edges.append((data_node(n), operation))
 
-        # clear compiled steps (must recompile after adding new layers)
-        self.steps = []
+        graph.add_edges_from(edges)
+
+        for name, data_type in types.items():
+            graph.nodes[name]['type'] = data_type
+
+        for operation in operations:
+            if operation.color:
+                graph.nodes[operation]['color'] = operation.color
+
+        # update the compiled steps if possible, or clear them (must
+        # recompile after adding new layers)
+        if not (self.steps and self._insert_steps(operations)):
+            self.steps = []
+        self._invalidate_plans(added=operations)
+
+    def remove_op(self, operation):
+        """
+        Removes the given operation from the network graph, along with the
+        data nodes no other operation needs or provides.  A compiled network
+        stays compiled.
+
+        :param Operation operation: Operation object to remove.
+        """
+        assert operation in self.graph, "Operation %s is not in the network" % operation.name
+        operation = self._graph_node(operation)
+
+        data = set(self.graph.predecessors(operation)) | set(self.graph.successors(operation))
+        downstream = [key for key in _walk(self.graph._succ, [operation]) if isinstance(key, str)]
+        self.graph.remove_node(operation)
+        orphans = set(d for d in data if not self.graph.degree(d))
+        self.graph.remove_nodes_from(orphans)
+
+        if self.steps:
+            self._remove_step(operation)
+        self._invalidate_plans(removed=[operation], names=orphans.union(downstream))
+
+    def replace_op(self, old, new):
+        """
+        Replaces the operation ``old`` with ``new``.  When both need and
+        provide the same data, the new operation takes the place of the old
+        one in the compiled steps and in the cached execution plans;
+        otherwise the old operation is removed and the new one added.
+
+        :param Operation old: Operation object to remove.
+        :param Operation new: Operation object to add in its place.
+        """
+        assert old in self.graph, "Operation %s is not in the network" % old.name
+        old = self._graph_node(old)
+
+        # the color and order decide which plans and where in them a layer runs
+        def signature(op):
+            return ([(n.name, n.type, n.optional) for n in op.needs],
+                    [(p.name, p.type) for p in op.provides],
+                    getattr(op, 'color', None), getattr(op, 'order', 0))
+
+        same_data = (signature(new) == signature(old) and
+                     not isinstance(old, Control) and not isinstance(new, Control))
+        if not same_data or (new != old and new in self.graph):
+            self.remove_op(old)
+            self.add_op(new)
+            return
+
+        edges = [(u, new) for u in self.graph.predecessors(old)] + \
+                [(new, v) for v in self.graph.successors(old)]
+        self.graph.remove_node(old)
+        self.graph.add_edges_from(edges)
+        if new.color:
+            self.graph.nodes[new]['color'] = new.color
+
+        def swap(steps):
+            return [new if step is old else step for step in steps]
+
+        self.steps = swap(self.steps)
+        for key, plan in self._necessary_steps_cache.items():
+            self._necessary_steps_cache[key] = swap(plan)
+
+        # the fingerprint changes with the operation
+        self._compile_cache = None
+
+    def _graph_node(self, operation):
+        """Returns the operation object stored in the graph equal to ``operation``."""
+        graph = self.graph
+        for data in chain(graph.predecessors(operation), graph.successors(operation)):
+            for node in chain(graph.predecessors(data), graph.successors(data)):
+                if node == operation:
+                    return node
+        return operation
+
+    def _insert_steps(self, operations):
+        """
+        Inserts newly added layers into the compiled steps, each right after
+        the last layer providing data it needs, and moves the instructions
+        deleting its needs after it when it is their last user.  Returns
+        ``False`` when that is not possible and the network must be compiled
+        from scratch (e.g. for control flow layers, whose relative order
+        matters).
+        """
+        if len(operations) > 64 or any(isinstance(op, Control) for op in operations):
+            return False
+
+        graph = self.graph
+        steps = list(self.steps)
+        for operation in operations:
+            needs = list(OrderedDict.fromkeys(n.name for n in operation.needs))
+            users_of = set(needs)
+            provides = set(p.name for p in operation.provides)
+
+            # the layers (by id) providing the needs, consuming what this one
+            # provides, and sharing its needs.
+            own = id(operation)
+            producers = set(id(op) for n in needs for op in graph.predecessors(n)) - {own}
+            consumers = set(id(op) for p in provides for op in graph.successors(p)) - {own}
+            users = {}
+            for n in needs:
+                for op in graph.successors(n):
+                    if op is not operation:
+                        users.setdefault(id(op), []).append(n)
+
+            # insert after the last producer of a need, before the first
+            # consumer of something provided.
+            lo, hi = -1, len(steps)
+            used_at, deletes = [], {}
+            for i, step in enumerate(steps):
+                if isinstance(step, DeleteInstruction):
+                    if step in users_of:
+                        deletes[step] = i
+                    continue
+                if isinstance(step, Control):
+                    return False
+                sid = id(step)
+                if sid in producers:
+                    lo = i
+                if sid in consumers and i < hi:
+                    hi = i
+                if sid in users:
+                    used_at.append((i, users[sid]))
+            if lo >= hi:
+                return False
+
+            needed_later = set(n for i, names in used_at if i > lo for n in names)
+            last_used = [n for n in needs if n not in needed_later]
+            drop = sorted((deletes[n] for n in last_used if n in deletes), reverse=True)
+            for i in drop:
+                del steps[i]
+            at = lo + 1 - sum(1 for i in drop if i <= lo)
+            steps[at:at] = [operation] + [DeleteInstruction(n) for n in last_used]
+
+        self.steps = steps
+        return True
+
+    def _remove_step(self, operation):
+        """
+        Removes a layer from the compiled steps, moving the instructions that
+        deleted its needs after the previous layer using them (if any).
+        """
+        steps = list(self.steps)
+        index = next(i for i, step in enumerate(steps) if step is operation)
+        end = index + 1
+        while end < len(steps) and isinstance(steps[end], DeleteInstruction):
+            end += 1
+        deletes = steps[index + 1:end]
+        del steps[index:end]
+
+        for delete in deletes:
+            users = set(id(op) for op in self.graph.successors(delete)) if delete in self.graph else ()
+            for i in range(index - 1, -1, -1):
+                if id(steps[i]) in users:
+                    steps.insert(i + 1, delete)
+                    index += 1
+                    break
+
+        self.steps = steps
+
+    def _invalidate_plans(self, added=(), removed=(), names=()):
+        """
+        Drops the cached execution plans that adding or removing the given
+        layers may change: plans requesting all outputs, plans containing a
+        removed layer or a layer touching data an added layer provides, and
+        plans with inputs or outputs among the data downstream of an added
+        layer or among ``names``.  Inputs matter as well as outputs, since
+        the layers upstream of the inputs are pruned from a plan.
+        """
+        self._compile_cache = None
+        if not self.steps:
+            self._necessary_steps_cache = {}
+            return
+
+        provided = set(p.name for op in added for p in op.provides)
+        names = set(names)
+        names.update(key for key in _walk(self.graph._succ, added) if isinstance(key, str))
+        related = set(id(op) for op in removed)
+        for name in provided:
+            for op in chain(self.graph.predecessors(name), self.graph.successors(name)):
+                related.add(id(op))
+
+        for key, plan in list(self._necessary_steps_cache.items()):
+            outputs = key[-2]
+            if not outputs or names.intersection(outputs) or names.intersection(key[:-2]) or \
+                    any(id(step) in related for step in plan):
+                del self._necessary_steps_cache[key]
+
+    def eliminate_common_subexpressions(self):
+        """
+        Finds layers that compute the same thing as another layer: same class
+        and function, the same (or aliased) needs, equal ``params`` and the
+        same color.  Each duplicate is replaced by an :class:`AliasOperation`
+        providing its outputs from the outputs of the layer kept, so the
+        computation runs only once.  Duplicates are found transitively, e.g.
+        identical layers consuming the outputs of merged layers are merged
+        too.
+
+        Only layers with a ``fn`` (created with ``operation``) are considered,
+        and their functions are assumed to have no side effects.
+
+        :returns: A dict mapping the name of every merged layer to the name of
+                  the layer it was merged into.  Merges accumulate in
+                  ``cse_merges``.
+        """
+        canonical = {}
+        seen = {}
+        merges = []
+
+        for node in nx.topological_sort(self.graph):
+            if not isinstance(node, Operation):
+                continue
+            for p in node.provides:
+                canonical.setdefault(p.name, p.name)
+            if getattr(node, 'fn', None) is None or isinstance(node, (Control, AliasOperation)):
+                continue
+            if getattr(node, 'stream', False):
+                # a stream can only be consumed once, so it can't be shared
+                continue
+
+            key = (type(node), node.fn, node.color, node.order,
+                   tuple((canonical.get(n.name, n.name), n.type, n.optional) for n in node.needs),
+                   tuple(p.type for p in node.provides))
+            try:
+                hash(key)
+            except TypeError:
+                continue
+
+            for kept in seen.setdefault(key, []):
+                if _same_params(kept.params, node.params):
+                    merges.append((node, kept))
+                    for p, kept_p in zip(node.provides, kept.provides):
+                        canonical[p.name] = canonical[kept_p.name]
+                    break
+            else:
+                seen[key].append(node)
+
+        for duplicate, kept in merges:
+            alias = AliasOperation(name=duplicate.name,
+                                   needs=[Var(p.name, p.type) for p in kept.provides],
+                                   provides=duplicate.provides,
+                                   color=duplicate.color)
+            self.replace_op(duplicate, alias)
+
+        merged = OrderedDict((duplicate.name, kept.name) for duplicate, kept in merges)
+        self.cse_merges.update(merged)
+        return merged
+
+    def fuse_chains(self, keep=()):
+        """
+        Merges every maximal linear chain of layers into a single
+        :class:`FusedOperation` calling them back to back, which saves the
+        per-step overhead of ``compute``.  A layer is chained to the next
+        one when the next one is the only consumer of everything it
+        provides, both have the same color, and none of that data is in
+        ``keep``.  The data inside a chain is no longer part of the graph,
+        so it can't be requested as an output or passed as an input.
+
+        Control flow layers, subgraphs and layers with a ``reduce`` function
+        are never fused.
+
+        :param keep: Names of data to keep visible, e.g. outputs requested
+                     by callers.
+
+        :returns: A dict mapping the name of every fused layer to the names
+                  of the layers in its chain.  Fusions accumulate in
+                  ``fused_chains``.
+        """
+        keep = set(keep)
+        graph = self.graph
+
+        def fusible(op):
+            return isinstance(op, Operation) and \
+                not isinstance(op, (Control, NetworkOperation)) and \
+                getattr(op, 'reduce', None) is None and \
+                not getattr(op, 'io_bound', False) and \
+                not getattr(op, 'resources', None) and \
+                not getattr(op, 'stream', False)
+
+        def chained_consumer(op):
+            consumer = None
+            for p in op.provides:
+                successors = list(graph.successors(p.name))
+                if p.name in keep or graph.in_degree(p.name) != 1 or len(successors) != 1:
+                    return None
+                if consumer is not None and successors[0] is not consumer:
+                    return None
+                consumer = successors[0]
+            if consumer is not None and fusible(consumer) and consumer.color == op.color:
+                return consumer
+            return None
+
+        ops = [node for node in nx.topological_sort(graph) if isinstance(node, Operation)]
+        following = {}
+        preceding = {}
+        for op in ops:
+            consumer = chained_consumer(op) if fusible(op) else None
+            if consumer is not None:
+                following[op] = consumer
+                preceding.setdefault(consumer, []).append(op)
+        # a layer continues only a chain it is the sole link of
+        for consumer, producers in preceding.items():
+            if len(producers) > 1:
+                for op in producers:
+                    del following[op]
+        preceding = {consumer: op for op, consumer in following.items()}
+
+        chains = []
+        for op in ops:
+            if op in following and op not in preceding:
+                chain = [op]
+                while chain[-1] in following:
+                    chain.append(following[chain[-1]])
+                chains.append(chain)
+
+        fused = OrderedDict()
+        for chain in chains:
+            needs = OrderedDict()
+            for i, op in enumerate(chain):
+                internal = set(p.name for p in chain[i - 1].provides) if i else set()
+                for n in op.needs:
+                    if n.name in internal:
+                        continue
+                    if n.name not in needs or needs[n.name].optional and not n.optional:
+                        needs[n.name] = n
+
+            op = FusedOperation(name='%s..%s' % (chain[0].name, chain[-1].name),
+                                needs=list(needs.values()),
+                                provides=chain[-1].provides,
+                                params={},
+                                color=chain[0].color,
+                                chunk_safe=all(getattr(op, 'chunk_safe', False) for op in chain),
+                                batched=all(getattr(op, 'batched', False) for op in chain),
+                                operations=chain)
+            for link in chain:
+                self.remove_op(link)
+            self.add_op(op)
+            fused[op.name] = [link.name for link in chain]
+
+        self.fused_chains.update(fused)
+        return fused
+
+    def bind(self, constants):
+        """
+        Returns a new compiled network specialized for the given constant
+        inputs.  Every layer that depends only on constants (or on no data
+        at all) is evaluated once, here, and left out of the new network;
+        its results are kept, with the constants, in the new network's
+        ``constants`` and added to the inputs of every call.  Calls return
+        these results like other computed data.  Inputs passed to
+        ``compute`` still take precedence over bound values.
+
+        Layers with optional needs that are not constants, and control flow
+        layers, are never evaluated at this point.
+
+        :param dict constants: The values of the inputs that never change,
+                               keyed by name.
+
+        :returns: A new ``Network``.
+        """
+        known, folded = self._fold_constants(constants)
+        remaining = [node for node in self.graph if isinstance(node, Operation) and node not in folded]
+        return self._derive(remaining, known, folded)
+
+    def specialize(self, fixed_inputs, outputs=None, name='specialized'):
+        """
+        Returns a graph computing ``outputs`` with the ``fixed_inputs``
+        bound: every layer depending only on them is evaluated once, here,
+        as in :meth:`bind`, and the layers not needed for the ``outputs``
+        are left out.  The needs of the returned graph are only the inputs
+        that still vary.
+
+        :param dict fixed_inputs: The values of the inputs that stay fixed,
+                                  keyed by name.
+
+        :param list outputs: The names of the outputs the graph is used
+                             for, or ``None`` for all of them.
+
+        :param str name: The name of the returned graph.
+
+        :returns: A compiled ``NetworkOperation``.
+        """
+        for output_name in outputs or ():
+            if not self.graph.has_node(output_name) and output_name not in fixed_inputs \
+                    and output_name not in self.constants:
+                raise ValueError("graphkit graph does not have an output "
+                                 "node named %s" % output_name)
+
+        known, folded = self._fold_constants(fixed_inputs)
+        ops = [node for node in self.graph if isinstance(node, Operation) and node not in folded]
+
+        if outputs:
+            # the layers the outputs depend on, stopping at known data
+            needed = set()
+            stack = [output_name for output_name in outputs if output_name not in known]
+            while stack:
+                for op in self.graph.predecessors(stack.pop()):
+                    if op not in folded and id(op) not in needed:
+                        needed.add(id(op))
+                        stack.extend(n.name for n in op.needs if n.name not in known)
+            ops = [op for op in ops if id(op) in needed]
+
+        # without outputs, the graph provides the folded data too
+        computed = [name for name in known if name in self.folded or
+                    any(p.name == name for op in folded for p in op.provides)]
+        provided = set(p.name for op in ops for p in op.provides)
+        used = set(n.name for op in ops for n in op.needs) | set(outputs or computed)
+        net = self._derive(ops, {k: v for k, v in known.items() if k in used}, folded)
+
+        needs = OrderedDict()
+        for op in ops:
+            for n in op.needs:
+                if n.name in provided or n.name in known:
+                    continue
+                if n.name not in needs or needs[n.name].optional and not n.optional:
+                    needs[n.name] = n
+        if outputs:
+            provides = [Var(output_name, self.graph.nodes[output_name].get('type', object)
+                            if self.graph.has_node(output_name) else object)
+                        for output_name in outputs]
+        else:
+            provides = OrderedDict((name, Var(name, self.graph.nodes[name].get('type', object)
+                                              if self.graph.has_node(name) else object))
+                                   for name in computed)
+            provides.update((p.name, p) for op in ops for p in op.provides)
+            provides = list(provides.values())
+
+        return NetworkOperation(name=name, needs=list(needs.values()), provides=provides, params={}, net=net)
+
+    def _fold_constants(self, constants):
+        """
+        Evaluates the layers depending only on the given constants (and on
+        the network's own).  Returns all the data known this way, and the
+        set of layers evaluated.
+        """
+        assert self.steps, "network must be compiled before binding constants."
+
+        known = dict(self.constants)
+        known.update(constants)
+        folded = set()
+        for step in self.steps:
+            # streams are left to calls, since they can only be consumed once
+            if isinstance(step, Operation) and not isinstance(step, Control) \
+                    and not getattr(step, 'stream', False) \
+                    and all(n.name in known for n in step.needs):
+                layer_outputs = step._compute(known)
+                check_output_types(step, layer_outputs)
+                known.update(layer_outputs)
+                folded.add(step)
+        return known, folded
+
+    def _derive(self, operations, constants, folded=()):
+        """
+        Returns a new compiled network of the given layers and constants,
+        some of which computed by the ``folded`` layers.
+        """
+        net = Network(debug=self._debug, stats_alpha=self._stats_alpha,
+                      stats_window=self._stats_window)
+        net.add_ops(operations)
+        net.constants = constants
+        net.folded = set(name for name in constants if name in self.folded) | \
+            set(p.name for op in folded for p in op.provides if p.name in constants)
+        if operations:
+            net.compile()
+        return net
+
+    def _hidden_inputs(self, named_inputs):
+        """
+        Returns the names of the data left out of the results of a call
+        without outputs: the inputs given to it, and the bound constants
+        that weren't computed by folding layers.
+        """
+        return set(named_inputs).union(name for name in self.constants if name not in self.folded)
+
+    def _add_constants(self, named_inputs):
+        """Returns the inputs of a call, completed with the bound constants."""
+        if not self.constants:
+            return named_inputs
+        inputs = dict(self.constants)
+        inputs.update(named_inputs)
+        return inputs
+
+    def _check_type(self, types, var, kind):
+        """
+        Records the type of the data ``var`` in ``types``, raising a TypeError
+        if it conflicts with a type already declared for the same name.
+        """
+        if var.name in types:
+            expected = types[var.name]
+        elif var.name in self.graph:
+            expected = self.graph.nodes[var.name].get('type')
+        else:
+            expected = None
+
+        if expected is None:
+            types[var.name] = var.type
+        elif expected != var.type:
+            raise TypeError("Duplicate nodes with different types. %s: %s Expected: %s Got: %s" %
+                            (kind, var.name, expected, var.type))
 
     def list_layers(self):
         assert self.steps, "network must be compiled before listing layers."
@@ -117,9 +853,81 @@ class Network(object):
                 print("\t", "condition needs: ", step.condition_needs)
             print("")
 
-    def compile(self):
+    def fingerprint(self):
+        """
+        Returns a stable structural fingerprint of the network: a hex digest
+        of the names, classes, needs, provides, types, orders and colors of
+        its layers (and of the networks nested in them) and of the names of
+        its data, in the order they were added.  Functions and params are
+        not part of it.
+        """
+        type_names = {}
+
+        def type_name(t):
+            name = type_names.get(t)
+            if name is None:
+                name = type_names[t] = '%s.%s' % (getattr(t, '__module__', ''), getattr(t, '__qualname__', repr(t)))
+            return name
+
+        items = []
+        for node in self.graph.nodes:
+            if isinstance(node, Operation):
+                items.append('op %r %s %r %r' % (node.name, type_name(type(node)), node.order, node.color))
+                for n in node.needs:
+                    items.append('need %r %s %r' % (n.name, type_name(n.type), n.optional))
+                for p in node.provides:
+                    items.append('provide %r %s' % (p.name, type_name(p.type)))
+                if isinstance(node, NetworkOperation):
+                    items.append('net %s' % node.net.fingerprint())
+                elif isinstance(node, Control):
+                    items.append('control %r %s' % (list(getattr(node, 'condition_needs', ())),
+                                                    node.graph.net.fingerprint()))
+            else:
+                items.append('data %r' % str(node))
+        return hashlib.sha256('\n'.join(items).encode('utf-8')).hexdigest()
+
+    def compile(self, cache=None):
         """Create a set of steps for evaluating layers
-           and freeing memory as necessary"""
+           and freeing memory as necessary
+
+        :param CompileCache cache: If given, the steps and execution plans of
+                                   a structurally identical network found in
+                                   the cache are reused, and otherwise the
+                                   ones compiled here are stored in it.
+        """
+
+        if cache is None:
+            self._compile_cache = None
+            self._compile()
+            return
+
+        fingerprint = self.fingerprint()
+        entry = cache.get(fingerprint)
+        if entry is None or not self._restore_steps(entry):
+            self._compile()
+            cache.put(fingerprint, [('op', step.name) if isinstance(step, Operation) else ('del', str(step))
+                                    for step in self.steps])
+        self._compile_cache = (cache, fingerprint)
+
+    def _restore_steps(self, entry):
+        """
+        Takes the steps and plans of a compile cache entry, returning
+        ``False`` if they don't match the layers of the graph.
+        """
+        layers = {node.name: node for node in self.graph if isinstance(node, Operation)}
+        try:
+            steps = [layers[name] if kind == 'op' else DeleteInstruction(name) for kind, name in entry['steps']]
+        except KeyError:
+            return False
+        if sum(1 for kind, _ in entry['steps'] if kind == 'op') != len(layers):
+            return False
+
+        self.steps = steps
+        self._necessary_steps_cache = {key: [steps[i] for i in indices]
+                                       for key, indices in entry['plans'].items()}
+        return True
+
+    def _compile(self):
 
         # clear compiled steps
         self.steps = []
@@ -135,8 +943,7 @@ class Network(object):
                 else:
                     return 0
 
-            ordered_nodes = list(nx.dag.lexicographical_topological_sort(self.graph,
-                                                                         key=key))
+            ordered_nodes = _lexicographical_topological_sort(self.graph, key)
         except TypeError as e:
             if self._debug:
                 print("Lexicographical topological sort failed! Falling back to topological sort.")
@@ -147,6 +954,13 @@ class Network(object):
                 print("Topological sort failed!")
                 raise e
 
+        # the position of the last layer needing each data node.
+        last_use = {}
+        for i, node in enumerate(ordered_nodes):
+            if isinstance(node, Operation):
+                for n in node.needs:
+                    last_use[n.name] = i
+
         # add Operations evaluation steps, and instructions to free data.
         for i, node in enumerate(ordered_nodes):
 
@@ -169,12 +983,7 @@ class Network(object):
                     if self._debug:
                         print("checking if node %s can be deleted" % predecessor)
 
-                    predecessor_still_needed = False
-                    for future_node in ordered_nodes[i+1:]:
-                        if isinstance(future_node, Operation):
-                            if predecessor in map(lambda arg: arg.name, future_node.needs):
-                                predecessor_still_needed = True
-                                break
+                    predecessor_still_needed = last_use.get(predecessor, -1) > i
                     if not predecessor_still_needed:
                         if self._debug:
                             print("  adding delete instruction for %s" % predecessor)
@@ -183,6 +992,113 @@ class Network(object):
             else:
                 raise TypeError("Unrecognized network graph node")
 
+    def _record_time(self, name, seconds, times=None):
+        """
+        Records the execution time of the layer ``name`` in its rolling
+        latency statistics and, if given, in the ``times`` of a call.
+        Returns the rounded time.
+        """
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats.setdefault(name, LatencyStats(self._stats_alpha, self._stats_window))
+        stats.update(seconds)
+        if self.metrics is not None:
+            self.metrics.observe(name, seconds)
+
+        t_complete = round(seconds, 5)
+        if times is not None:
+            times[name] = t_complete
+        return t_complete
+
+    def _estimate_costs(self, estimate='ewma'):
+        """
+        Returns the estimated execution time of every layer according to its
+        latency statistics.  Layers that never ran are assumed to take the
+        mean estimate of the others (or 1 if nothing ran yet).
+        """
+        ops = [node for node in self.graph.nodes if isinstance(node, Operation)]
+        costs = {}
+        for op in ops:
+            if op.name in self.stats:
+                value = self.stats[op.name].estimate(estimate)
+                if value is not None:
+                    costs[op] = value
+
+        default = sum(costs.values()) / len(costs) if costs else 1.0
+        for op in ops:
+            costs.setdefault(op, default)
+        return costs
+
+    def _upstream_ops(self, op):
+        """Returns the layers providing the data ``op`` needs."""
+        return set(producer for data in self.graph.predecessors(op)
+                   for producer in self.graph.predecessors(data))
+
+    def _remaining_path_lengths(self, estimate='ewma'):
+        """
+        Returns, for every layer, the estimated time of the longest path from
+        the start of that layer to the end of the graph.  Schedulers running
+        layers in parallel prefer the ready layers with the longest remaining
+        path, since those bound the end-to-end latency.
+        """
+        costs = self._estimate_costs(estimate)
+        remaining = {}
+        for node in reversed(list(nx.topological_sort(self.graph))):
+            if isinstance(node, Operation):
+                downstream = [remaining[succ] for data in self.graph.successors(node)
+                              for succ in self.graph.successors(data)]
+                remaining[node] = costs[node] + max(downstream or [0])
+        return remaining
+
+    def critical_path(self, outputs=None, estimate='ewma'):
+        """
+        Reports the chain of layers that bounds the end-to-end latency of the
+        network, according to the latency statistics recorded by previous
+        calls.
+
+        :param list outputs:
+            Only consider the layers needed to compute these outputs.  By
+            default the whole graph is considered.
+
+        :param estimate:
+            The statistic used for the cost of each layer: ``'ewma'``
+            (default), ``'mean'``, ``'max'`` or a percentile such as ``95``.
+
+        :returns:
+            A list of ``(layer_name, estimated_seconds)`` tuples, in execution
+            order.  Their sum is the estimated latency of the critical path.
+        """
+        costs = self._estimate_costs(estimate)
+
+        candidates = None
+        if outputs:
+            candidates = set()
+            for output_name in outputs:
+                if not self.graph.has_node(output_name):
+                    raise ValueError("graphkit graph does not have an output "
+                                     "node named %s" % output_name)
+                candidates |= nx.ancestors(self.graph, output_name)
+
+        length, previous = {}, {}
+        for node in nx.topological_sort(self.graph):
+            if not isinstance(node, Operation):
+                continue
+            upstream = [op for op in self._upstream_ops(node) if op in length]
+            best = max(upstream, key=lambda op: length[op]) if upstream else None
+            previous[node] = best
+            length[node] = costs[node] + (length[best] if best is not None else 0)
+
+        ends = [op for op in length if candidates is None or op in candidates]
+        if not ends:
+            return []
+
+        path = []
+        node = max(ends, key=lambda op: length[op])
+        while node is not None:
+            path.append((node.name, costs[node]))
+            node = previous[node]
+        return list(reversed(path))
+
     def _find_necessary_steps(self, outputs, inputs, color=None):
         """
         Determines what graph steps need to be run to get to the requested
@@ -211,67 +1127,81 @@ class Network(object):
         outputs = tuple(sorted(outputs)) if isinstance(outputs, (list, set)) else outputs
         inputs_keys = tuple(sorted(inputs.keys()))
         cache_key = (*inputs_keys, outputs, color)
-        if cache_key in self._necessary_steps_cache:
-            return self._necessary_steps_cache[cache_key]
+        necessary_steps = self._necessary_steps_cache.get(cache_key)
+        if self.metrics is not None:
+            self.metrics.plan_lookup(necessary_steps is not None)
+        if necessary_steps is not None:
+            return necessary_steps
+
+        with self._plan_lock:
+            necessary_steps = self._necessary_steps_cache.get(cache_key)
+            if necessary_steps is None:
+                necessary_steps = self._necessary_steps_cache[cache_key] = \
+                    self._plan_necessary_steps(outputs, inputs, color)
+                if self._compile_cache is not None:
+                    cache, fingerprint = self._compile_cache
+                    positions = {id(step): i for i, step in enumerate(self.steps)}
+                    cache.put_plan(fingerprint, cache_key, [positions[id(step)] for step in necessary_steps])
+            return necessary_steps
+
+    def _plan_necessary_steps(self, outputs, inputs, color):
+        """Computes the result of ``_find_necessary_steps``, without caching."""
         graph = self.graph
         if not outputs:
 
             # If caller requested all outputs, the necessary nodes are all
             # nodes that are reachable from one of the inputs.  Ignore input
             # names that aren't in the graph.
-            necessary_nodes = set()
+            necessary_nodes = _walk(graph._succ, [name for name in inputs if graph.has_node(name)])
             subgraphs = list(filter(lambda node: isinstance(node, NetworkOperation) or isinstance(node, Control), graph.nodes))
             for input_name in iter(inputs):
-                if graph.has_node(input_name):
-                    necessary_nodes |= nx.descendants(graph, input_name)
                 for subgraph in subgraphs:
                     if isinstance(subgraph, NetworkOperation) and subgraph.net.graph.has_node(input_name):
-                        necessary_nodes.add(subgraph)
+                        necessary_nodes[id(subgraph)] = subgraph
                     elif isinstance(subgraph, Control) and subgraph.graph.net.graph.has_node(input_name):
-                        necessary_nodes.add(subgraph)
+                        necessary_nodes[id(subgraph)] = subgraph
         else:
 
             # If the caller requested a subset of outputs, find any nodes that
             # are made unecessary because we were provided with an input that's
             # deeper into the network graph.  Ignore input names that aren't
             # in the graph.
-            unnecessary_nodes = set()
-            for input_name in iter(inputs):
-                if graph.has_node(input_name):
-                    unnecessary_nodes |= nx.ancestors(graph, input_name)
+            unnecessary_nodes = _walk(graph._pred, [name for name in inputs if graph.has_node(name)])
 
             # Find the nodes we need to be able to compute the requested
             # outputs.  Raise an exception if a requested output doesn't
             # exist in the graph.
-            necessary_nodes = set()
+            sources = []
             for output_name in outputs:
                 if not graph.has_node(output_name):
+                    if output_name in inputs:
+                        continue
                     raise ValueError("graphkit graph does not have an output "
                                      "node named %s" % output_name)
-                necessary_nodes |= nx.ancestors(graph, output_name)
+                sources.append(output_name)
+            necessary_nodes = _walk(graph._pred, sources)
 
             # Get rid of the unnecessary nodes from the set of necessary ones.
-            necessary_nodes -= unnecessary_nodes
+            for key in unnecessary_nodes:
+                necessary_nodes.pop(key, None)
 
         necessary_steps = []
 
         for step in self.steps:
             if isinstance(step, Operation):
-                if step.color == color and step in necessary_nodes:
+                if step.color == color and id(step) in necessary_nodes:
                     necessary_steps.append(step)
-                elif isinstance(step, Control) and step in necessary_nodes:
+                elif isinstance(step, Control) and id(step) in necessary_nodes:
                     necessary_steps.append(step)
             else:
                 if step in necessary_nodes:
                     necessary_steps.append(step)
 
-        # save this result in a precomputed cache for future lookup
-        self._necessary_steps_cache[cache_key] = necessary_steps
-
         # Return an ordered list of the needed steps.
         return necessary_steps
 
-    def compute(self, outputs, named_inputs, color=None):
+    def compute(self, outputs, named_inputs, color=None, lazy=False, memory=False,
+                checkpoint=None, resume_from=None):
         """
         This method runs the graph one operation at a time in a single thread
         Any inputs to the network must be passed in by name.
@@ -288,31 +1218,207 @@ class Network(object):
 
         :param str color: Only the subgraph of nodes with color will be evaluted.
 
+        :param bool lazy: If ``True``, nothing is computed up front.  Instead a
+                          :class:`LazyResults` mapping is returned, which runs
+                          only the steps needed for a key when it is first
+                          accessed.
+
+        :param memory: If ``True`` or a :class:`MemoryReport`, the size of
+                       every data and of the live data cache after every
+                       step are recorded in the report, which is also kept
+                       in ``memory_report``.
+
+        :param checkpoint: A directory or a :class:`graphkit.checkpoint.Checkpoint`
+                           to save the live data cache to after the selected
+                           steps, for a later call to resume from.
+
+        :param str resume_from: The directory of a checkpoint saved by a call
+                                with the same inputs and outputs.  The steps
+                                done by that call are skipped.
+
         :returns: a dictionary of output data objects, keyed by name.
         """
 
-        # assert that network has been compiled
-        assert self.steps, "network must be compiled before calling compute."
+        # assert that network has been compiled, unless it was bound to
+        # constants that left nothing to compute.
+        assert self.steps or (self.constants and not len(self.graph)),\
+            "network must be compiled before calling compute."
         assert isinstance(outputs, (list, tuple)) or outputs is None,\
             "The outputs argument must be a list"
 
-        # start with fresh data cache
-        cache = {}
+        hidden = self._hidden_inputs(named_inputs)
+        named_inputs = self._add_constants(named_inputs)
+
+        if self.metrics is not None:
+            self.metrics.call()
 
-        # add inputs to data cache
-        cache.update(named_inputs)
+        if lazy:
+            return LazyResults(self, outputs, named_inputs, color, hidden)
+
+        # start with fresh data cache, holding the inputs, in a context of
+        # its own so concurrent calls don't share any state.
+        context = ExecutionContext(dict(named_inputs), outputs, color)
+        cache = context.cache
 
         # Find the subset of steps we need to run to get to the requested
         # outputs from the provided inputs.
         all_steps = self._find_necessary_steps(outputs, named_inputs, color)
 
-        self.times = {}
-        if_true = False
+        if checkpoint is not None or resume_from is not None:
+            context.plan = [_step_key(step) for step in all_steps]
+        if checkpoint is not None:
+            context.checkpoint = checkpoint if isinstance(checkpoint, Checkpoint) else Checkpoint(checkpoint)
+        if resume_from is not None:
+            context.resumed, resumed, context.if_true = resume(resume_from, context.plan, context.checkpoint)
+            cache.update(resumed)
+            context.deferred.difference_update(resumed)
+            all_steps = all_steps[context.resumed:]
+
+        if memory:
+            context.memory = memory if isinstance(memory, MemoryReport) else MemoryReport()
+            context.memory._start(cache)
+            try:
+                self._run_steps(all_steps, context)
+            finally:
+                context.memory._stop()
+            self.memory_report = context.memory
+        else:
+            self._run_steps(all_steps, context)
+        self.times = context.times
+
+        if not outputs:
+            # Return cache as output including intermediate data nodes,
+            # but excluding input.
+            return {k: cache[k] for k in set(cache) - hidden}
 
-        for step in all_steps:
+        else:
+            # Filter outputs to just return what's needed.
+            # Note: list comprehensions exist in python 2.7+
+            if context.deferred:
+                resolve_loaders(outputs, cache, context.deferred)
+            return {k: cache[k] for k in iter(cache) if k in outputs}
+
+    def _run_steps(self, all_steps, context):
+        """
+        Runs the given compiled steps in order, reading inputs from and
+        writing results to the cache of the :class:`ExecutionContext`.  Data
+        is only deleted from the cache when specific outputs are requested.
+
+        I/O-bound operations are started in the background as soon as their
+        needs are computed, and joined when a later step needs their outputs.
+        """
+        prefetch = self._prefetch_schedule(all_steps)
+        if not prefetch:
+            return self._run_steps_in_order(all_steps, context)
+
+        pool = ThreadPoolExecutor(max_workers=min(sum(map(len, prefetch.values())), 32))
+        try:
+            self._run_steps_in_order(all_steps, context, prefetch, pool)
+        finally:
+            pool.shutdown(wait=False)
+
+    def _prefetch_schedule(self, all_steps):
+        """
+        Returns a dict mapping step indices to the I/O-bound operations that
+        can be started once the step at that index is done, -1 standing for
+        before the first step.
+        """
+        schedule = {}
+        last_provider = {}
+        for i, step in enumerate(all_steps):
+            if getattr(step, 'io_bound', False) and not isinstance(step, Control):
+                ready = max([last_provider.get(n.name, -1) for n in step.needs] or [-1])
+                schedule.setdefault(ready, []).append(step)
+            if isinstance(step, Operation):
+                for p in step.provides:
+                    last_provider[p.name] = i
+        return schedule
+
+    def _start_prefetch(self, steps, context, pool, running):
+        cache = context.cache
+        for step in steps:
+            # needs might be missing, e.g. when provided by a branch not taken
+            # or by an operation still running: the step then runs in order
+            if all(n.name in cache for n in step.needs if not n.optional):
+                if context.streams:
+                    feed_streams(step, [n.name for n in step.needs], cache, context.streams)
+                inputs = {n.name: cache[n.name] for n in step.needs if n.name in cache}
+                running[id(step)] = pool.submit(_timed_prefetch, step, inputs)
+
+    def _join_prefetched(self, step, context, running, waiting):
+        """Waits for an operation started in the background, and keeps its outputs."""
+        memory = context.memory
+        if memory is not None:
+            memory._before_op(step)
+        try:
+            layer_outputs, t_elapsed = running.pop(id(step)).result()
+            check_output_types(step, layer_outputs)
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.error(step.name)
+            raise
+        for p in step.provides:
+            waiting.pop(p.name, None)
+        if getattr(step, 'stream', False):
+            self._keep_streams(layer_outputs, context)
+        context.cache.update(layer_outputs)
+        self._record_time(step.name, t_elapsed, context.times)
+        if memory is not None:
+            memory._after_op(step, layer_outputs)
+
+    def _keep_streams(self, layer_outputs, context):
+        if context.consumers is None:
+            context.consumers = stream_consumers(context.steps)
+        keep_streams(layer_outputs, context.consumers, context.outputs, context.streams)
+
+    def _save_checkpoint(self, done, context, if_true):
+        """Saves the cache of a call having run ``done`` of its steps, besides those resumed."""
+        cache = context.cache
+        if context.deferred:
+            # inputs still deferred are given again on resume
+            cache = {k: v for k, v in cache.items() if k not in context.deferred}
+        context.checkpoint._save(context.plan, context.resumed + done, cache, if_true)
+
+    def _run_steps_in_order(self, all_steps, context, prefetch=None, pool=None):
+        cache, outputs, color, memory = context.cache, context.outputs, context.color, context.memory
+        context.steps, context.consumers = all_steps, None
+        if_true = context.if_true
+        pending_checkpoint = False
+
+        # operations started in the background, by id, and the data they
+        # will provide once their step has been reached
+        running = {}
+        waiting = {}
+        if prefetch:
+            self._start_prefetch(prefetch.get(-1, ()), context, pool, running)
+
+        for i, step in enumerate(all_steps):
+
+            # save once the data deleted after the last operation is gone,
+            # when no operation is running in the background and no stream
+            # is half consumed
+            if pending_checkpoint and not isinstance(step, DeleteInstruction) and \
+                    not running and not context.streams:
+                self._save_checkpoint(i, context, if_true)
+                pending_checkpoint = False
+
+            if waiting:
+                if isinstance(step, DeleteInstruction):
+                    names = [step]
+                else:
+                    names = [n.name for n in step.needs] + list(getattr(step, 'condition_needs', ()))
+                for name in names:
+                    if name in waiting:
+                        self._join_prefetched(waiting[name], context, running, waiting)
+
+            if isinstance(step, Control) and context.streams:
+                names = [n.name for n in step.needs] + list(getattr(step, 'condition_needs', ()))
+                feed_streams(step, names, cache, context.streams)
 
             if isinstance(step, Control):
                 if hasattr(step, 'condition'):
+                    if context.deferred:
+                        resolve_loaders(step.condition_needs, cache, context.deferred)
                     if all(map(lambda need: need in cache, step.condition_needs)):
                         if_true = step._compute_condition(cache)
                         if if_true:
@@ -327,29 +1433,48 @@ class Network(object):
                     cache.update(layer_outputs)
                     if_true = False
 
+            elif id(step) in running:
+                # joined once a later step needs its outputs
+                waiting.update((p.name, step) for p in step.provides)
+
             elif isinstance(step, Operation):
 
                 if self._debug:
                     print("-"*32)
                     print("executing step: %s" % step.name)
 
+                if context.deferred:
+                    resolve_loaders([n.name for n in step.needs], cache, context.deferred)
+                if context.streams:
+                    feed_streams(step, [n.name for n in step.needs], cache, context.streams)
+
+                if memory is not None:
+                    memory._before_op(step)
+
                 # time execution...
                 t0 = time.time()
 
                 # compute layer outputs
-                layer_outputs = step._compute(cache)
-
-                for output in step.provides:
-                    if output.name in layer_outputs and not isinstance(layer_outputs[output.name], output.type):
-                        raise TypeError("Type mismatch. Operation: %s Output: %s Expected: %s Got: %s" %
-                                        (step.name, output.name, output.type, type(layer_outputs[output.name])))
+                try:
+                    layer_outputs = step._compute(cache)
+                    t_elapsed = time.time() - t0
+                    check_output_types(step, layer_outputs)
+                except Exception:
+                    if self.metrics is not None:
+                        self.metrics.error(step.name)
+                    raise
 
                 # add outputs to cache
+                if getattr(step, 'stream', False):
+                    self._keep_streams(layer_outputs, context)
                 cache.update(layer_outputs)
+                if context.checkpoint is not None and context.checkpoint._wants(step):
+                    pending_checkpoint = True
 
                 # record execution time
-                t_complete = round(time.time() - t0, 5)
-                self.times[step.name] = t_complete
+                t_complete = self._record_time(step.name, t_elapsed, context.times)
+                if memory is not None:
+                    memory._after_op(step, layer_outputs)
                 if self._debug:
                     print("step completion time: %s" % t_complete)
 
@@ -365,19 +1490,21 @@ class Network(object):
                         if self._debug:
                             print("removing data '%s' from cache." % step)
                         cache.pop(step)
+                        if memory is not None:
+                            memory._after_delete(step)
 
             else:
                 raise TypeError("Unrecognized instruction.")
 
-        if not outputs:
-            # Return cache as output including intermediate data nodes,
-            # but excluding input.
-            return {k: cache[k] for k in set(cache) - set(named_inputs)}
+            if prefetch and i in prefetch:
+                self._start_prefetch(prefetch[i], context, pool, running)
 
-        else:
-            # Filter outputs to just return what's needed.
-            # Note: list comprehensions exist in python 2.7+
-            return {k: cache[k] for k in iter(cache) if k in outputs}
+        # outputs nothing else needed
+        while waiting:
+            self._join_prefetched(next(iter(waiting.values())), context, running, waiting)
+
+        if pending_checkpoint:
+            self._save_checkpoint(len(all_steps), context, if_true)
 
     def plot(self, filename=None, show=False):
         """
@@ -0,0 +1,184 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a partitioner that splits the operations of a
+compiled network into ``k`` groups, balancing the compute load of the groups
+while minimizing the number of bytes that have to cross from one group to
+another.  The resulting placement can be handed to any multi-process
+executor, for example::
+
+    from graphkit.partition import partition
+
+    parts = partition(graph, 2, sizes=estimate_sizes(graph(inputs)))
+    executor.compute(graph, outputs, inputs, placement=parts.placement)
+"""
+
+from .base import Operation, NetworkOperation
+from .memory import sizeof
+
+
+def estimate_sizes(values):
+    """
+    Estimates the size in bytes of every value in ``values``, a dict of data
+    names to values such as the one returned by a call to a graph.  Arrays
+    are measured with their ``nbytes`` attribute, other objects with
+    ``sys.getsizeof``.
+    """
+    return {name: sizeof(value) for name, value in values.items()}
+
+
+class Partition(object):
+    """
+    The result of :func:`partition`.
+
+    :ivar dict placement:
+        Maps every operation name to the index of its partition.
+
+    :ivar list loads:
+        The total compute cost of every partition.
+
+    :ivar int cut_bytes:
+        The estimated number of bytes transferred between partitions (and
+        from the caller to the partitions consuming graph inputs).
+    """
+
+    def __init__(self, placement, loads, cut_bytes):
+        self.placement = placement
+        self.loads = loads
+        self.cut_bytes = cut_bytes
+
+    @property
+    def parts(self):
+        """The list of operation names in each partition."""
+        parts = [[] for _ in self.loads]
+        for name, part in self.placement.items():
+            parts[part].append(name)
+        return parts
+
+    def __repr__(self):
+        return u"Partition(loads=%s, cut_bytes=%s, parts=%s)" % (self.loads, self.cut_bytes, self.parts)
+
+
+class _Problem(object):
+    """The compiled graph reduced to operations, their costs and data edges."""
+
+    def __init__(self, net, costs, sizes, default_cost, default_size):
+        self.ops = [step for step in net.steps if isinstance(step, Operation)]
+        self.cost = {op: costs.get(op.name) or default_cost for op in self.ops}
+
+        self.producer = {}
+        self.consumers = {}
+        for op in self.ops:
+            for p in op.provides:
+                self.producer[p.name] = op
+        for op in self.ops:
+            for name in set(n.name for n in op.needs):
+                self.consumers.setdefault(name, []).append(op)
+
+        names = set(self.producer) | set(self.consumers)
+        self.size = {name: sizes.get(name, default_size) for name in names}
+        self.touches = {op: set(n.name for n in op.needs) | set(p.name for p in op.provides)
+                        for op in self.ops}
+
+    def data_cut(self, name, placement):
+        """Bytes moved for ``name``: one copy for every other partition consuming it."""
+        producer = self.producer.get(name)
+        source = placement.get(producer) if producer is not None else None
+        dests = set(placement[c] for c in self.consumers.get(name, ()) if c in placement)
+        dests.discard(source)
+        return self.size[name] * len(dests)
+
+    def total_cut(self, placement):
+        return sum(self.data_cut(name, placement) for name in self.size)
+
+
+def partition(net, k, costs=None, sizes=None, imbalance=0.1, passes=10):
+    """
+    Splits the operations of a compiled network into ``k`` partitions.
+
+    Operations are first assigned greedily, in topological order, to the
+    partition that adds the fewest transferred bytes without exceeding its
+    share of the total compute cost.  The assignment is then refined by
+    moving single operations between partitions while that lowers the bytes
+    crossing partition edges and keeps the loads balanced.
+
+    :param net:
+        A compiled ``Network``, or a ``NetworkOperation`` created with
+        ``compose``.
+
+    :param int k:
+        The number of partitions.
+
+    :param dict costs:
+        The estimated compute cost of operations, keyed by operation name.
+        Defaults to the timings recorded in ``net.times`` by the last call;
+        operations without a (non zero) estimate count as the mean known
+        cost.
+
+    :param dict sizes:
+        The estimated size in bytes of data nodes, keyed by name (see
+        :func:`estimate_sizes`).  Data without an estimate count as 1 byte,
+        so without any sizes the number of crossing edges is minimized.
+
+    :param float imbalance:
+        How much heavier than ``1 / k`` of the total cost a partition may get.
+
+    :param int passes:
+        The maximum number of refinement passes.
+
+    :returns:
+        A :class:`Partition`.
+    """
+    assert k > 0, "the number of partitions must be positive"
+    if isinstance(net, NetworkOperation):
+        net = net.net
+    assert net.steps, "network must be compiled before partitioning."
+
+    costs = net.times if costs is None else costs
+    known = [c for c in costs.values() if c > 0]
+    default_cost = sum(known) / len(known) if known else 1.0
+    problem = _Problem(net, costs, sizes or {}, default_cost, 1)
+
+    total = sum(problem.cost.values())
+    capacity = (1.0 + imbalance) * total / k
+    loads = [0.0] * k
+    placement = {}
+
+    # greedy assignment in topological order
+    for op in problem.ops:
+
+        def score(part):
+            placement[op] = part
+            added = sum(problem.data_cut(name, placement) for name in problem.touches[op])
+            del placement[op]
+            overloaded = loads[part] + problem.cost[op] > capacity
+            return (overloaded, added, loads[part])
+
+        part = min(range(k), key=score)
+        placement[op] = part
+        loads[part] += problem.cost[op]
+
+    # refinement by single moves that lower the cut and respect capacity
+    for _ in range(passes):
+        improved = False
+        for op in problem.ops:
+            current = placement[op]
+            before = sum(problem.data_cut(name, placement) for name in problem.touches[op])
+            best, best_gain = current, 0
+            for part in range(k):
+                if part == current or loads[part] + problem.cost[op] > capacity:
+                    continue
+                placement[op] = part
+                gain = before - sum(problem.data_cut(name, placement) for name in problem.touches[op])
+                if gain > best_gain:
+                    best, best_gain = part, gain
+            placement[op] = best
+            if best != current:
+                loads[current] -= problem.cost[op]
+                loads[best] += problem.cost[op]
+                improved = True
+        if not improved:
+            break
+
+    return Partition({op.name: part for op, part in placement.items()},
+                     loads, problem.total_cut(placement))
@@ -0,0 +1,363 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a scheduler that runs the independent operations of
+a compiled network concurrently on a pool of threads.  It is most useful when
+operations release the GIL, e.g. for I/O or numerical code.
+
+Whenever several operations are ready to run, the one with the longest
+estimated path to the end of the graph (according to the latency statistics
+the network recorded in earlier calls) is started first, since those
+operations bound the end-to-end latency::
+
+    from graphkit.scheduler import ParallelScheduler
+
+    with ParallelScheduler(max_workers=4) as scheduler:
+        results = scheduler.compute(graph, ['e'], {'a': 1, 'b': 2})
+
+Operations can declare the resources they hold while running, e.g.
+``operation(..., resources={'mem_gb': 4, 'db': 1})``.  Given the capacity of
+these resources, the scheduler never runs operations holding more than that
+at once, across all the calls it serves, and starts the next ready operation
+that fits instead::
+
+    scheduler = ParallelScheduler(max_workers=8, resources={'mem_gb': 8, 'db': 2})
+
+Calls sharing a scheduler share its threads fairly: every call names a
+priority class, and the classes with operations waiting to start get
+threads in proportion to their weights, calls of the same class taking
+turns.  A large batch call then can't hold back interactive ones::
+
+    scheduler = ParallelScheduler(max_workers=8, weights={'interactive': 8, 'batch': 1})
+    scheduler.compute(graph, ['e'], inputs, priority='interactive')
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .base import Operation, NetworkOperation, Control
+from .network import check_output_types
+from .loaders import deferred_names, resolve_loaders
+from .streaming import keep_streams
+from .stats import LatencyStats
+
+
+def _timed_compute(op, cache, deferred):
+    if deferred:
+        resolve_loaders([n.name for n in op.needs], cache, deferred)
+    t0 = time.time()
+    layer_outputs = op._compute(cache)
+    if getattr(op, 'stream', False):
+        # streams are materialized, since operations run on several threads
+        keep_streams(layer_outputs, {}, None, set())
+    return layer_outputs, time.time() - t0
+
+
+class _ResourcePool(object):
+    """
+    The capacity of named resources shared by the calls of a scheduler, and
+    statistics on how long operations queued for them.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = dict(capacity)
+        self.in_use = dict.fromkeys(capacity, 0)
+        self._stats = {name: {'acquired': 0, 'queued': 0, 'wait_time': 0.0, 'max_wait': 0.0, 'peak': 0}
+                       for name in capacity}
+        self._released = threading.Condition()
+
+    def check(self, op):
+        for name, amount in (getattr(op, 'resources', None) or {}).items():
+            if name in self.capacity and amount > self.capacity[name]:
+                raise ValueError("Operation '%s' needs %s of resource '%s', more than its capacity %s" %
+                                 (op.name, amount, name, self.capacity[name]))
+
+    def shortage(self, op):
+        """Returns the resources ``op`` would need more of to run now."""
+        return [name for name, amount in (getattr(op, 'resources', None) or {}).items()
+                if name in self.capacity and self.in_use[name] + amount > self.capacity[name]]
+
+    def try_acquire(self, op, waited_for=(), wait_time=0.0):
+        """
+        Takes the resources of ``op`` if they are all available, recording
+        that it waited ``wait_time`` seconds for the ``waited_for`` ones.
+        """
+        with self._released:
+            if self.shortage(op):
+                return False
+            for name, amount in (getattr(op, 'resources', None) or {}).items():
+                if name in self.capacity:
+                    self.in_use[name] += amount
+                    stats = self._stats[name]
+                    stats['acquired'] += 1
+                    stats['peak'] = max(stats['peak'], self.in_use[name])
+            for name in waited_for:
+                stats = self._stats[name]
+                stats['queued'] += 1
+                stats['wait_time'] += wait_time
+                stats['max_wait'] = max(stats['max_wait'], wait_time)
+            return True
+
+    def release(self, op):
+        with self._released:
+            for name, amount in (getattr(op, 'resources', None) or {}).items():
+                if name in self.capacity:
+                    self.in_use[name] -= amount
+            self._released.notify_all()
+
+    def wait_for_release(self, timeout):
+        with self._released:
+            self._released.wait(timeout)
+
+    def snapshot(self):
+        with self._released:
+            return {name: dict(stats, capacity=self.capacity[name], in_use=self.in_use[name])
+                    for name, stats in self._stats.items()}
+
+
+class _FairShare(object):
+    """
+    The threads of a scheduler, handed out to the calls waiting for one by
+    stride scheduling: every class advances its virtual time by the inverse
+    of its weight for each operation it starts, and the waiting call of the
+    class behind the others goes next, first come first served within a
+    class.
+    """
+
+    def __init__(self, slots, weights):
+        self.free = slots
+        self.weights = dict(weights)
+        self._passes = {}
+        self._vtime = 0.0
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._changed = threading.Condition()
+
+    def _next(self):
+        return min(self._waiting, key=lambda ticket: (self._passes[ticket[0]], ticket[1]))
+
+    def acquire(self, priority):
+        """Waits for a thread to start an operation of a call of class ``priority``."""
+        with self._changed:
+            if not any(waiting == priority for waiting, _ in self._waiting):
+                # a class becoming active doesn't get credit for idle time
+                self._passes[priority] = max(self._passes.get(priority, 0.0), self._vtime)
+            ticket = (priority, next(self._tickets))
+            self._waiting.append(ticket)
+            while not (self.free and self._next() == ticket):
+                self._changed.wait()
+            self._waiting.remove(ticket)
+            self.free -= 1
+            self._vtime = self._passes[priority]
+            self._passes[priority] += 1.0 / self.weights.get(priority, 1)
+            self._changed.notify_all()
+
+    def release(self):
+        with self._changed:
+            self.free += 1
+            self._changed.notify_all()
+
+
+class ParallelScheduler(object):
+    """
+    Runs the necessary steps of a compiled network on a pool of threads,
+    starting the ready operation on the critical path first.
+
+    :param int max_workers:
+        The number of threads.
+
+    :param estimate:
+        The latency statistic used to estimate the cost of operations, as
+        accepted by :meth:`Network.critical_path`.
+
+    :param dict resources:
+        The capacity of the resources operations declare, by name.
+        Resources without a capacity are not limited.
+
+    :param dict weights:
+        The share of the threads given to each priority class of calls
+        while several compete for them.  Classes not listed weigh 1.
+
+    :ivar dict latency:
+        The end-to-end latency statistics of calls, by priority class.
+    """
+
+    def __init__(self, max_workers=None, estimate='ewma', resources=None, weights=None):
+        self.max_workers = max_workers or 4
+        self.estimate = estimate
+        self.latency = {}
+        self._resources = _ResourcePool(resources or {})
+        self._share = _FairShare(self.max_workers, weights or {})
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def resource_stats(self):
+        """
+        Returns, for every resource with a capacity, a dict with its
+        ``capacity``, the amount ``in_use`` and the ``peak`` amount used,
+        the number of operations that ``acquired`` it and of those that
+        ``queued`` for it, and the total and maximum time, in seconds, they
+        queued (``wait_time`` and ``max_wait``).
+        """
+        return self._resources.snapshot()
+
+    def shutdown(self):
+        """Stops the threads of this scheduler."""
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+
+    def _run(self, op, cache, deferred):
+        try:
+            return _timed_compute(op, cache, deferred)
+        finally:
+            self._share.release()
+
+    def compute(self, net, outputs, named_inputs, color=None, priority='default'):
+        """
+        Runs the network.  The arguments and the return value are the same as
+        for :meth:`Network.compute`, and execution times are recorded in the
+        network's ``times`` and ``stats`` the same way.
+
+        :param net:
+            A compiled ``Network``, or a ``NetworkOperation`` created with
+            ``compose``.
+
+        :param priority:
+            The priority class of this call, sharing the threads with the
+            calls of other classes according to their ``weights``.
+        """
+        t0 = time.time()
+        try:
+            return self._compute(net, outputs, named_inputs, color, priority)
+        finally:
+            stats = self.latency.get(priority)
+            if stats is None:
+                stats = self.latency.setdefault(priority, LatencyStats())
+            stats.update(time.time() - t0)
+
+    def _compute(self, net, outputs, named_inputs, color, priority_class):
+        if isinstance(net, NetworkOperation):
+            net = net.net
+
+        assert net.steps, "network must be compiled before calling compute."
+        assert isinstance(outputs, (list, tuple)) or outputs is None,\
+            "The outputs argument must be a list"
+
+        if net.metrics is not None:
+            net.metrics.call()
+
+        hidden = net._hidden_inputs(named_inputs)
+        named_inputs = net._add_constants(named_inputs)
+        all_steps = net._find_necessary_steps(outputs, named_inputs, color)
+        if any(isinstance(step, Control) for step in all_steps):
+            raise TypeError("Control flow operations can not be run by the ParallelScheduler")
+        ops = [step for step in all_steps if isinstance(step, Operation)]
+        for op in ops:
+            self._resources.check(op)
+        priority = net._remaining_path_lengths(self.estimate)
+
+        producers = {}
+        for op in ops:
+            for p in op.provides:
+                producers[p.name] = op
+
+        waiting_on, consumers, remaining = {}, {}, {}
+        for op in ops:
+            deps = set(producers[n.name] for n in op.needs
+                       if n.name in producers and producers[n.name] is not op)
+            waiting_on[op] = deps
+            for dep in deps:
+                consumers.setdefault(dep, []).append(op)
+            for n in op.needs:
+                remaining[n.name] = remaining.get(n.name, 0) + 1
+
+        # ready operations, ordered by longest remaining path then plan order
+        order = {op: i for i, op in enumerate(ops)}
+        ready = [(-priority[op], order[op], op) for op in ops if not waiting_on[op]]
+        heapq.heapify(ready)
+
+        cache = dict(named_inputs)
+        deferred = deferred_names(cache)
+        running = {}
+        failure = None
+        times = {}
+
+        # when and for which resources ready operations started queuing
+        queued = {}
+
+        while (ready or running) and failure is None:
+            blocked = []
+            while ready and len(running) < self.max_workers:
+                entry = heapq.heappop(ready)
+                op = entry[2]
+                since, short = queued.get(op, (None, ()))
+                wait_time = time.time() - since if since is not None else 0.0
+                if not self._resources.try_acquire(op, short, wait_time):
+                    # try the next ready operation that fits
+                    if op not in queued:
+                        queued[op] = (time.time(), self._resources.shortage(op))
+                    blocked.append(entry)
+                    continue
+                queued.pop(op, None)
+                self._share.acquire(priority_class)
+                try:
+                    running[self._pool.submit(self._run, op, cache, deferred)] = op
+                except BaseException:
+                    # e.g. the scheduler was shut down
+                    self._share.release()
+                    self._resources.release(op)
+                    raise
+            for entry in blocked:
+                heapq.heappush(ready, entry)
+
+            if not running:
+                # the resources are held by other calls
+                self._resources.wait_for_release(0.05)
+                continue
+
+            # other calls might release the resources blocked operations need
+            done, _ = wait(list(running), timeout=0.05 if blocked else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                op = running.pop(future)
+                self._resources.release(op)
+                try:
+                    layer_outputs, elapsed = future.result()
+                    check_output_types(op, layer_outputs)
+                except Exception as e:
+                    if net.metrics is not None:
+                        net.metrics.error(op.name)
+                    failure = failure or e
+                    continue
+
+                cache.update(layer_outputs)
+                net._record_time(op.name, elapsed, times)
+
+                for n in op.needs:
+                    remaining[n.name] -= 1
+                    if remaining[n.name] == 0 and outputs and n.name not in outputs:
+                        cache.pop(n.name, None)
+
+                for consumer in consumers.get(op, ()):
+                    waiting_on[consumer].discard(op)
+                    if not waiting_on[consumer]:
+                        heapq.heappush(ready, (-priority[consumer], order[consumer], consumer))
+
+        if failure is not None:
+            wait(list(running))
+            for op in running.values():
+                self._resources.release(op)
+            raise failure
+
+        net.times = times
+        if not outputs:
+            return {k: cache[k] for k in set(cache) - hidden}
+        else:
+            return {k: cache[k] for k in iter(cache) if k in outputs}
@@ -0,0 +1,108 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains a runner computing a composed graph for every
+record of a large batch on a pool of worker processes.  The batch is split
+into shards of consecutive records, and the results of all shards are
+merged back in the order of the records::
+
+    from graphkit.sharding import ShardedRunner
+
+    with ShardedRunner(graph, processes=8, shard_size=1000) as runner:
+        results = runner.map(records, outputs=['score'])
+
+The graph is pickled once, and every worker unpickles it once when it
+starts, so whatever its operations set up in ``_after_init`` is reused for
+all the shards the worker runs.  Operations are pickled, so their functions
+must be importable by name (e.g. module level functions rather than
+lambdas).
+"""
+
+import os
+import time
+import pickle
+import multiprocessing
+
+# the graph run by this worker process
+_graph = None
+
+
+def _init_worker(payload):
+    global _graph
+    _graph = pickle.loads(payload)
+
+
+def _run_shard(args):
+    index, records, shared, outputs = args
+    t0 = time.time()
+    results = []
+    for record in records:
+        if shared:
+            record = dict(shared, **record)
+        results.append(_graph(record, outputs=outputs))
+    return index, results, time.time() - t0, os.getpid()
+
+
+class ShardedRunner(object):
+    """
+    Runs a composed graph on shards of a batch of records in worker
+    processes.
+
+    :param graph:
+        A ``NetworkOperation`` created with ``compose``.
+
+    :param int processes:
+        The number of worker processes, by default the number of CPUs.
+
+    :param int shard_size:
+        The number of records in every shard.
+
+    :ivar list shards:
+        For every shard of the last batch, in order, a dict with its index
+        (``shard``), its number of ``records``, the ``seconds`` its worker
+        took, its ``throughput`` in records per second and the pid of its
+        ``worker``.
+    """
+
+    def __init__(self, graph, processes=None, shard_size=1000):
+        assert shard_size > 0, "shard_size must be positive"
+        self.shard_size = shard_size
+        self.shards = []
+        self._pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                          initargs=(pickle.dumps(graph, pickle.HIGHEST_PROTOCOL),))
+
+    def map(self, records, outputs=None, shared=None):
+        """
+        Computes the graph for every record, a dict of named inputs, and
+        returns the list of results in the order of the records.
+
+        :param list outputs:
+            The outputs to return for every record.  If ``None``, all the
+            data computed from a record is returned.
+
+        :param dict shared:
+            Named inputs common to all the records, shipped with every shard.
+        """
+        records = list(records)
+        shards = [(i, records[start:start + self.shard_size], shared, outputs)
+                  for i, start in enumerate(range(0, len(records), self.shard_size))]
+
+        results = []
+        self.shards = []
+        for index, shard_results, seconds, pid in self._pool.imap(_run_shard, shards):
+            results.extend(shard_results)
+            self.shards.append({'shard': index, 'records': len(shard_results), 'seconds': seconds,
+                                'throughput': len(shard_results) / seconds if seconds else None,
+                                'worker': pid})
+        return results
+
+    def close(self):
+        """Stops the worker processes."""
+        self._pool.close()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,100 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains the coalescing of concurrent identical calls used
+by graphs composed with ``compose(..., coalesce=True)``: while a call is in
+flight, other calls with the same inputs, outputs and color wait for it and
+receive its result (or its exception) instead of computing it again.
+"""
+
+import pickle
+import hashlib
+import threading
+
+
+def _freeze(value):
+    """
+    Returns a hashable stand-in for ``value``, equal for equal values of the
+    same type: ``1``, ``1.0`` and ``True`` are told apart.
+    """
+    if type(value) is tuple:
+        return (tuple, tuple(_freeze(item) for item in value))
+    try:
+        hash(value)
+        return (type(value), value)
+    except TypeError:
+        pass
+
+    if hasattr(value, 'tobytes') and hasattr(value, 'dtype'):
+        return ('array', str(value.dtype), getattr(value, 'shape', None),
+                hashlib.blake2b(value.tobytes(), digest_size=16).digest())
+    return ('pickle', hashlib.blake2b(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), digest_size=16).digest())
+
+
+def fingerprint(named_inputs, outputs=None, color=None):
+    """
+    Returns a hashable key identifying a call by its inputs, outputs and
+    color, or ``None`` if some input can be neither hashed nor pickled.
+    Arrays are identified by their dtype, shape and contents.
+    """
+    try:
+        inputs = tuple(sorted((name, _freeze(value)) for name, value in named_inputs.items()))
+    except Exception:
+        return None
+    outputs = tuple(sorted(outputs)) if outputs else None
+    return (inputs, outputs, color)
+
+
+class _Call(object):
+    """A call in flight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Runs at most one call at a time per key; calls made with the same key
+    while it is running wait for it and share its outcome.
+
+    :ivar int shared: The number of calls that waited for another one
+                      instead of running.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, fn):
+        """
+        Returns ``fn()``, or the result of the call with the same ``key``
+        already in flight.  Exceptions are raised to every waiter.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
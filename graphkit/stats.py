@@ -0,0 +1,89 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains the rolling latency statistics a ``Network`` keeps
+for each of its operations across calls.
+"""
+
+import math
+import threading
+
+from collections import deque
+
+
+class LatencyStats(object):
+    """
+    Rolling execution time statistics of a single operation: an exponentially
+    weighted moving average, and a window of the most recent samples from
+    which percentiles are computed.  Samples can be recorded from several
+    threads at once.
+
+    :param float alpha:
+        The weight of the newest sample in the moving average.
+
+    :param int window:
+        The number of recent samples kept for percentiles.
+    """
+
+    def __init__(self, alpha=0.2, window=100):
+        assert 0 < alpha <= 1, "alpha must be in (0, 1]"
+        self.alpha = alpha
+        self.count = 0
+        self.ewma = None
+        self.samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def update(self, seconds):
+        """Records one execution time."""
+        with self._lock:
+            self.count += 1
+            self.samples.append(seconds)
+            if self.ewma is None:
+                self.ewma = seconds
+            else:
+                self.ewma += self.alpha * (seconds - self.ewma)
+
+    def _recent(self):
+        # a copy, as sorting or summing the deque fails if it is updated meanwhile
+        with self._lock:
+            return list(self.samples)
+
+    def percentile(self, q):
+        """
+        Returns the ``q``-th percentile (0 to 100) of the recent samples, or
+        ``None`` if nothing was recorded yet.
+        """
+        ordered = sorted(self._recent())
+        if not ordered:
+            return None
+        rank = int(math.ceil(q / 100.0 * len(ordered))) - 1
+        return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+    def estimate(self, which='ewma'):
+        """
+        Returns the estimate named by ``which``: ``'ewma'``, ``'mean'``,
+        ``'max'`` or a percentile given as a number.
+        """
+        if which == 'ewma':
+            return self.ewma
+        samples = self._recent()
+        if not samples:
+            return None
+        elif which == 'mean':
+            return sum(samples) / len(samples)
+        elif which == 'max':
+            return max(samples)
+        return self.percentile(which)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return u"LatencyStats(count=%s, ewma=%s, p50=%s, p95=%s)" % \
+            (self.count, self.ewma, self.percentile(50), self.percentile(95))
@@ -0,0 +1,66 @@
+# Copyright 2016, Yahoo Inc.
+# Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
+"""
+This sub-module contains the handling of streams: outputs of operations
+declared with ``stream=True`` that are iterators, typically because their
+function is a generator.  Such an output is not materialized in the cache
+when a single operation of the plan needs it and it is not requested: if
+that operation is declared with ``stream=True`` too, it is handed the
+iterator and pulls its items one at a time, so a chain of them runs as a
+pipeline in constant memory::
+
+    @operation(name='read', needs=['path'], provides='records', stream=True)
+    def read(path):
+        with open(path) as f:
+            for line in f:
+                yield line
+
+    @operation(name='parse', needs=['records'], provides='rows', stream=True)
+    def parse(records):
+        for record in records:
+            yield record.split(',')
+
+    @operation(name='count', needs=['rows'], provides='n', stream=True)
+    def count(rows):
+        return sum(1 for row in rows)
+
+Other operations are given a list of the items instead.  The execution time
+of the items pulled is recorded for the operation pulling them.
+"""
+
+from collections.abc import Iterator
+
+
+def stream_consumers(all_steps):
+    """Returns the number of operations needing every data in ``all_steps``."""
+    consumers = {}
+    for step in all_steps:
+        for n in getattr(step, 'needs', ()):
+            consumers[n.name] = consumers.get(n.name, 0) + 1
+    return consumers
+
+
+def keep_streams(layer_outputs, consumers, outputs, streams):
+    """
+    Adds to the set ``streams`` the outputs of an operation declared with
+    ``stream=True`` that can be kept as iterators, and replaces the other
+    iterators with lists in ``layer_outputs``.
+    """
+    for name, value in layer_outputs.items():
+        if isinstance(value, Iterator):
+            if outputs and name not in outputs and consumers.get(name, 0) == 1:
+                streams.add(name)
+            else:
+                layer_outputs[name] = list(value)
+
+
+def feed_streams(step, names, cache, streams):
+    """
+    Prepares the streams among the data ``names`` for ``step``: operations
+    declared with ``stream=True`` pull from them, others get lists.
+    """
+    for name in names:
+        if name in streams:
+            streams.discard(name)
+            if not getattr(step, 'stream', False):
+                cache[name] = list(cache[name])
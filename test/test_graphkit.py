@@ -2,13 +2,21 @@
 # Licensed under the terms of the Apache License, Version 2.0. See the LICENSE file associated with the project for terms.
 
 import math
+import os
+import time
+import pickle
+import tempfile
 
 from pprint import pprint
 from operator import add, sub, mul
 from numpy.testing import assert_raises
 
 import graphkit.modifiers as modifiers
-from graphkit import operation, compose, If, ElseIf, Else, Var
+from graphkit import operation, compose, If, ElseIf, Else, Var, Network, Operation
+from graphkit.distributed import LocalCluster, DistributedExecutor
+from graphkit.partition import partition, estimate_sizes
+from graphkit.scheduler import ParallelScheduler
+from graphkit.functional import FunctionalOperation
 
 
 def test_network():
@@ -318,3 +326,1177 @@ def test_type_checking():
 
     out = graph({'a': 2, 'b': 5})
     assert out == {'abs_a_minus_ab_cubed': 512, 'a_minus_ab': -8, 'ab': 10}
+
+
+def test_distributed_executor():
+
+    import multiprocessing
+    from multiprocessing.connection import Client
+
+    graph = compose(name='graph')(
+        operation(name='sum', needs=['a', 'b'], provides=['apb'])(add),
+        operation(name='mul', needs=['a', 'b'], provides=['ab'])(mul),
+        operation(name='sub', needs=['apb', 'ab'], provides=['c'])(sub),
+        operation(name='square', needs=['c', 'c'], provides=['d'])(mul)
+    )
+    expected = graph({'a': 2, 'b': 3})
+
+    tmpdir = tempfile.mkdtemp()
+    addresses = [os.path.join(tmpdir, 'worker%d' % i) for i in range(2)]
+    with LocalCluster(2, addresses=addresses) as cluster:
+        executor = DistributedExecutor(cluster.addresses, authkey=cluster.authkey)
+
+        assert executor.compute(graph, None, {'a': 2, 'b': 3}) == expected
+        assert executor.compute(graph, ['d'], {'a': 2, 'b': 3}) == {'d': expected['d']}
+
+        # with a fixed placement, only data consumed on the other worker moves
+        placement = {'sum': 0, 'mul': 1, 'sub': 0, 'square': 0}
+        assert executor.compute(graph, ['d'], {'a': 2, 'b': 3}, placement=placement) == {'d': expected['d']}
+        assert executor.placement == placement
+        moved = set(name for name, source, dest in executor.transfers)
+        assert 'ab' in moved and 'apb' not in moved and 'c' not in moved
+
+        # errors raised by an operation are raised by the executor
+        assert_raises(TypeError, executor.compute, graph, ['d'], {'a': 2, 'b': 'x'})
+        assert executor.compute(graph, ['c'], {'a': 1, 'b': 1}) == {'c': 1}
+
+        executor.close()
+
+    # executors sharing workers don't overwrite each other's operations
+    g1 = compose(name='g1')(operation(name='op', needs=['a', 'b'], provides='c')(add))
+    g2 = compose(name='g2')(operation(name='op', needs=['a', 'b'], provides='c')(mul))
+    with LocalCluster(1) as cluster:
+        e1 = DistributedExecutor(cluster.addresses, authkey=cluster.authkey)
+        e2 = DistributedExecutor(cluster.addresses, authkey=cluster.authkey)
+        assert e1.compute(g1, ['c'], {'a': 2, 'b': 5}) == {'c': 7}
+        assert e2.compute(g2, ['c'], {'a': 2, 'b': 5}) == {'c': 10}
+        assert e1.compute(g1, ['c'], {'a': 2, 'b': 5}) == {'c': 7}
+        e1.close()
+        e2.close()
+
+        # a client with a wrong authkey is turned away, and the worker keeps serving
+        assert_raises(multiprocessing.AuthenticationError, Client, cluster.addresses[0], authkey=b'wrong')
+        executor = DistributedExecutor(cluster.addresses, authkey=cluster.authkey)
+        assert executor.compute(g1, ['c'], {'a': 2, 'b': 5}) == {'c': 7}
+        executor.close()
+
+
+def test_partition():
+    # two independent chains producing large intermediates, joined at the end
+    ops = []
+    for chain in ['x', 'y']:
+        ops.append(operation(name=chain + '1', needs=['a'], provides=chain + '1')(abs))
+        ops.append(operation(name=chain + '2', needs=[chain + '1'], provides=chain + '2')(abs))
+        ops.append(operation(name=chain + '3', needs=[chain + '2', chain + '1'], provides=chain + '3')(add))
+    ops.append(operation(name='join', needs=['x3', 'y3'], provides='z')(add))
+    graph = compose(name='graph')(*ops)
+
+    sizes = estimate_sizes(graph({'a': -1}))
+    assert sizes['x1'] > 0
+    sizes.update({'x1': 1000, 'x2': 1000, 'y1': 1000, 'y2': 1000})
+
+    parts = partition(graph, 2, costs={}, sizes=sizes)
+    assert sorted(len(p) for p in parts.parts) == [3, 4]
+    assert parts.placement['x1'] == parts.placement['x2'] == parts.placement['x3']
+    assert parts.placement['y1'] == parts.placement['y2'] == parts.placement['y3']
+    assert parts.placement['x1'] != parts.placement['y1']
+    assert max(parts.loads) <= 4
+
+    # a single partition never transfers anything between workers
+    single = partition(graph, 1)
+    assert set(single.placement.values()) == {0}
+    assert single.cut_bytes == 1
+
+
+def test_critical_path_and_parallel_scheduler():
+
+    def sleepy(seconds):
+        def fn(x):
+            time.sleep(seconds)
+            return x + 1
+        return fn
+
+    graph = compose(name='graph')(
+        operation(name='slow1', needs=['a'], provides=['s1'])(sleepy(0.02)),
+        operation(name='slow2', needs=['s1'], provides=['s2'])(sleepy(0.02)),
+        operation(name='fast', needs=['a'], provides=['f'])(sleepy(0)),
+        operation(name='join', needs=['s2', 'f'], provides=['j'])(add)
+    )
+
+    # statistics are kept across calls, unlike ``times``
+    for _ in range(3):
+        expected = graph({'a': 1})
+    stats = graph.net.stats
+    assert stats['slow1'].count == 3
+    assert stats['slow1'].ewma > stats['fast'].ewma
+    assert stats['slow2'].percentile(50) >= 0.02
+
+    path = graph.net.critical_path()
+    assert [name for name, cost in path] == ['slow1', 'slow2', 'join']
+    assert [name for name, cost in graph.net.critical_path(outputs=['f'])] == ['fast']
+
+    with ParallelScheduler(max_workers=2) as scheduler:
+        assert scheduler.compute(graph, None, {'a': 1}) == expected
+        assert scheduler.compute(graph, ['j'], {'a': 1}) == {'j': expected['j']}
+    assert graph.net.stats['slow1'].count == 5
+
+    # with a single thread, the operation on the critical path starts first
+    started = []
+    graph = compose(name='graph')(
+        operation(name='fast', needs=['a'], provides=['f'])(lambda a: started.append('fast') or a),
+        operation(name='slow1', needs=['a'], provides=['s1'])(lambda a: started.append('slow1') or a),
+        operation(name='slow2', needs=['s1'], provides=['s2'])(lambda a: started.append('slow2') or a)
+    )
+    with ParallelScheduler(max_workers=1) as scheduler:
+        scheduler.compute(graph, None, {'a': 1})
+    assert started[0] == 'slow1'
+
+
+def test_lazy_results():
+    calls = []
+
+    def counted(name, fn):
+        def wrapper(*args):
+            calls.append(name)
+            return fn(*args)
+        return wrapper
+
+    graph = compose(name='graph')(
+        operation(name='sum', needs=['a', 'b'], provides=['apb'])(counted('sum', add)),
+        operation(name='mul', needs=['apb', 'b'], provides=['x'])(counted('mul', mul)),
+        operation(name='sub', needs=['apb', 'a'], provides=['y'])(counted('sub', sub)),
+        operation(name='other', needs=['c'], provides=['z'])(counted('other', abs))
+    )
+
+    results = graph({'a': 1, 'b': 2}, outputs=['x', 'y'], lazy=True)
+    assert calls == []
+    assert len(results) == 2 and 'x' in results and 'z' not in results
+
+    # the shared intermediate is computed once, for the first key accessed
+    assert results['x'] == 6
+    assert calls == ['sum', 'mul']
+    assert results['y'] == 2
+    assert results['x'] == 6
+    assert calls == ['sum', 'mul', 'sub']
+    assert dict(results) == {'x': 6, 'y': 2}
+    assert_raises(KeyError, lambda: results['z'])
+
+    # without explicit outputs, every data node reachable from the inputs
+    results = graph({'a': 1, 'b': 2}, lazy=True)
+    assert sorted(results) == ['apb', 'x', 'y']
+    assert dict(results) == graph({'a': 1, 'b': 2})
+
+    # accesses in any order only cache one plan per key
+    for keys in (['x', 'y', 'apb'], ['y', 'apb', 'x'], ['apb', 'x', 'y']):
+        results = graph({'a': 1, 'b': 2}, outputs=['x', 'y', 'apb'], lazy=True)
+        assert [results[key] for key in keys] == [{'x': 6, 'y': 2, 'apb': 3}[key] for key in keys]
+    assert len(graph.net._necessary_steps_cache) <= 6
+
+
+def test_add_ops():
+    ops = [
+        operation(name='sum', needs=['a', 'b'], provides=['apb'])(add),
+        operation(name='mul', needs=['apb', 'b'], provides=['x'])(mul),
+        operation(name='sub', needs=['x', 'a'], provides=['y'])(sub)
+    ]
+
+    # adding in bulk compiles to the same steps as adding one at a time
+    bulk, single = Network(), Network()
+    bulk.add_ops(ops)
+    for op in ops:
+        single.add_op(op)
+    bulk.compile()
+    single.compile()
+    assert bulk.steps == single.steps
+    assert bulk.compute(['y'], {'a': 1, 'b': 2}) == {'y': 5}
+
+    # an invalid batch leaves the network untouched
+    net = Network()
+    net.add_ops(ops[:1])
+    assert_raises(AssertionError, net.add_ops, [ops[1], ops[1]])
+    assert_raises(TypeError, net.add_ops, [
+        ops[1], operation(name='typed', needs=[Var('x', int)], provides=['z'])(abs)])
+    assert_raises(TypeError, net.add_ops, [
+        operation(name='typed', needs=[Var('a', int)], provides=['z'])(abs),
+        operation(name='typed2', needs=[Var('a', float)], provides=['w'])(abs)])
+    assert len(net.graph) == 4
+
+    # merging keeps the order in which operations were given
+    merged = compose(name='merged', merge=True)(compose(name='first')(*ops[:2]), *ops)
+    assert [name for name, _ in merged.net.list_layers()] == ['sum', 'mul', 'sub']
+
+
+def test_incremental_compile():
+    sum_op = operation(name='sum', needs=['a', 'b'], provides=['apb'])(add)
+    other_op = operation(name='other', needs=['c'], provides=['z'])(abs)
+    net = Network()
+    net.add_ops([sum_op, operation(name='mul', needs=['apb', 'b'], provides=['x'])(mul), other_op])
+    net.compile()
+    assert net.compute(['x'], {'a': 1, 'b': 2}) == {'x': 6}
+    assert net.compute(['z'], {'c': -1}) == {'z': 1}
+    assert len(net._necessary_steps_cache) == 2
+
+    # replacing an operation with one using the same data keeps the plans
+    net.replace_op(sum_op, operation(name='sum', needs=['a', 'b'], provides=['apb'])(sub))
+    assert len(net._necessary_steps_cache) == 2
+    assert net.compute(['x'], {'a': 1, 'b': 2}) == {'x': -2}
+
+    # adding an operation keeps the network compiled, and only drops the
+    # plans touching the data it provides
+    net.add_op(operation(name='make_b', needs=['d'], provides=['b'])(abs))
+    assert net.steps
+    assert len(net._necessary_steps_cache) == 1
+    assert net.compute(['x'], {'a': 1, 'd': -2}) == {'x': -2}
+    assert net.compute(['x', 'z'], {'a': 1, 'd': -2, 'c': 3}) == {'x': -2, 'z': 3}
+
+    square_op = operation(name='square', needs=['x', 'x'], provides=['y'])(mul)
+    net.add_op(square_op)
+    assert net.compute(['y'], {'a': 1, 'd': -2}) == {'y': 4}
+
+    # removing operations moves the deletion of their needs
+    net.remove_op(square_op)
+    assert 'y' not in net.graph
+    assert net.compute(['x'], {'a': 1, 'd': -2}) == {'x': -2}
+
+    net.replace_op(other_op, operation(name='other2', needs=['c', 'x'], provides=['z'])(add))
+    assert net.compute(['z'], {'a': 1, 'd': -2, 'c': 3}) == {'z': 1}
+    incremental = net.compute(None, {'a': 1, 'd': -2, 'c': 3})
+
+    # the result matches a network compiled from scratch
+    net.compile()
+    assert net.compute(None, {'a': 1, 'd': -2, 'c': 3}) == incremental
+
+    # a replacement of another color is not swapped into the plans of the old one
+    op = operation(name='a', needs=['x'], provides=['y'])(abs)
+    net = Network()
+    net.add_ops([op, operation(name='b', needs=['x'], provides=['z'])(abs)])
+    net.compile()
+    assert net.compute(['y'], {'x': -1}) == {'y': 1}
+    net.replace_op(op, operation(name='a', needs=['x'], provides=['y'], color='red')(abs))
+    assert net.compute(['y'], {'x': -1}) == {}
+
+    # plans are dropped when the layers upstream of their inputs change, as
+    # those are pruned from them
+    def build(*ops):
+        net = Network()
+        net.add_ops(ops)
+        net.compile()
+        return net
+
+    double = operation(name='double', needs=['x'], provides=['m'])(lambda x: 2 * x)
+    make_i = operation(name='make_i', needs=['m'], provides=['i'])(abs)
+    make_j = operation(name='make_j', needs=['i'], provides=['j'])(abs)
+    net = build(double, make_j)
+    for inputs in ({'x': 1, 'i': 0}, {'x': 1, 'j': 0}):
+        assert net.compute(['m'], inputs) == {'m': 2}
+    net.add_op(make_i)
+    fresh = build(double, make_j, make_i)
+    for inputs in ({'x': 1, 'i': 0}, {'x': 1, 'j': 0}):
+        assert net.compute(['m'], inputs) == fresh.compute(['m'], inputs) == {}
+
+    net.remove_op(make_i)
+    fresh = build(double, make_j)
+    for inputs in ({'x': 1, 'i': 0}, {'x': 1, 'j': 0}):
+        assert net.compute(['m'], inputs) == fresh.compute(['m'], inputs) == {'m': 2}
+
+
+def test_common_subexpression_elimination():
+
+    calls = []
+
+    def feature(a, scale):
+        calls.append(a)
+        return a * scale
+
+    def plus(a, b):
+        return a + b
+
+    graph = compose(name='cse', cse=True)(
+        operation(name='feat1', needs='x', provides='f1', params={'scale': 2})(feature),
+        operation(name='feat2', needs='x', provides='f2', params={'scale': 2})(feature),
+        operation(name='feat3', needs='x', provides='f3', params={'scale': 3})(feature),
+        # identical once f2 is known to be an alias of f1
+        operation(name='sum1', needs=['f1', 'y'], provides='s1')(plus),
+        operation(name='sum2', needs=['f2', 'y'], provides='s2')(plus),
+        operation(name='total', needs=['s1', 's2', 'f3'], provides='t')(lambda a, b, c: a + b + c),
+    )
+
+    assert graph.net.cse_merges == {'feat2': 'feat1', 'sum2': 'sum1'}
+
+    results = graph({'x': 5, 'y': 1})
+    assert results['f1'] == results['f2'] == 10
+    assert results['s1'] == results['s2'] == 11
+    assert results['t'] == 37
+    assert calls == [5, 5]
+
+    # outputs of the merged operations can be requested on their own
+    assert graph({'x': 5, 'y': 1}, outputs=['s2']) == {'s2': 11}
+
+    # graphs with aliases can be pickled, e.g. to be shipped to workers
+    graph = compose(name='cse', cse=True)(
+        operation(name='sum', needs=['a', 'b'], provides='c')(add),
+        operation(name='sum2', needs=['a', 'b'], provides='d')(add),
+    )
+    assert pickle.loads(pickle.dumps(graph))({'a': 1, 'b': 2}, outputs=['d']) == {'d': 3}
+
+
+def test_bind_constants():
+
+    calls = []
+
+    def build_table(size):
+        calls.append(size)
+        return list(range(size))
+
+    graph = compose(name='bound', constants={'size': 4})(
+        operation(name='table', needs='size', provides='table')(build_table),
+        operation(name='offset', needs=[], provides='offset', params={'value': 10})(lambda value: value),
+        operation(name='lookup', needs=['table', 'offset', 'i'], provides='x')(lambda t, o, i: t[i] + o),
+    )
+
+    # only the operation depending on the runtime input is left
+    assert calls == [4]
+    assert [n.name for n in graph.needs] == ['i']
+    assert [name for name, _ in graph.net.list_layers()] == ['lookup']
+
+    # folded outputs are returned like other computed data, but not the constants
+    assert graph({'i': 2}) == {'table': [0, 1, 2, 3], 'offset': 10, 'x': 12}
+    assert set(graph({'i': 2})) == set(p.name for p in graph.provides)
+    assert graph({'i': 3}, outputs=['x', 'table']) == {'x': 13, 'table': [0, 1, 2, 3]}
+    assert calls == [4]
+
+    # runtime inputs take precedence over bound values
+    assert graph({'i': 1, 'offset': 0}) == {'table': [0, 1, 2, 3], 'x': 1}
+
+    # binding everything leaves nothing to compute
+    net = graph.net.bind({'i': 0})
+    assert net.compute(['x'], {}) == {'x': 10}
+
+
+def test_concurrent_compute():
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def slow_add(a, b):
+        time.sleep(0.001)
+        return a + b
+
+    graph = compose(name='concurrent')(
+        operation(name='sum1', needs=['a', 'b'], provides='c')(slow_add),
+        operation(name='sum2', needs=['c', 'b'], provides='d')(slow_add),
+        operation(name='sum3', needs=['c', 'd'], provides='e')(slow_add),
+    )
+
+    def call(i):
+        outputs = [['e'], ['d'], None][i % 3]
+        return i, graph({'a': i, 'b': 1}, outputs=outputs)
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        for i, results in pool.map(call, range(300)):
+            expected = {'c': i + 1, 'd': i + 2, 'e': 2 * i + 3}
+            if i % 3 == 2:
+                assert results == expected
+            else:
+                assert results == {k: expected[k] for k in [['e'], ['d']][i % 3]}
+
+    # one plan per distinct call, and statistics for every operation
+    assert len(graph.net._necessary_steps_cache) == 3
+    assert graph.net.stats['sum1'].count == 300
+    assert graph.net.stats['sum3'].count == 200
+
+    # networks holding a lock can still be pickled
+    graph = compose(name='picklable')(operation(name='sum', needs=['a', 'b'], provides='c')(add))
+    clone = pickle.loads(pickle.dumps(graph))
+    assert clone({'a': 1, 'b': 1}) == {'c': 2}
+
+    # and so can their statistics, which keep counting from their clones
+    graph({'a': 1, 'b': 1})
+    clone = pickle.loads(pickle.dumps(graph))
+    clone({'a': 1, 'b': 1})
+    assert clone.net.stats['sum'].count == 2 and graph.net.stats['sum'].count == 1
+
+    # networks pickled with only the attributes of older versions still work
+    state = {k: v for k, v in graph.net.__getstate__().items()
+             if k in ('graph', '_debug', 'times', 'steps', '_necessary_steps_cache')}
+    net = Network.__new__(Network)
+    net.__setstate__(state)
+    assert net.compute(None, {'a': 1, 'b': 2}) == {'c': 3}
+    assert net.stats['sum'].count == 1 and net.constants == {}
+
+
+def test_compute_chunked():
+
+    import numpy as np
+    from graphkit.chunked import compute_chunked
+
+    graph = compose(name='chunked')(
+        operation(name='bias', needs='k', provides='bias')(lambda k: k + 1),
+        operation(name='scale', needs=['x', 'bias'], provides='scaled', chunk_safe=True)(lambda x, b: x * 2 + b),
+        operation(name='rowsum', needs='scaled', provides='rowsum', chunk_safe=True)(lambda s: s.sum(axis=1)),
+        operation(name='total', needs='rowsum', provides='total', reduce=sum)(lambda r: r.sum()),
+        operation(name='mean', needs=['total', 'x_rows'], provides='mean')(lambda t, n: t / n),
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        x = np.lib.format.open_memmap(os.path.join(tmp, 'x.npy'), mode='w+', dtype='f8', shape=(10, 3))
+        x[:] = np.arange(30).reshape(10, 3)
+        rowsum = np.lib.format.open_memmap(os.path.join(tmp, 'rowsum.npy'), mode='w+', dtype='f8', shape=(10,))
+
+        inputs = {'x': x, 'k': 1, 'x_rows': 10}
+        outputs = ['scaled', 'rowsum', 'total', 'mean']
+        results = compute_chunked(graph, outputs, inputs, chunked=['x'], chunk_size=4, out={'rowsum': rowsum})
+        assert graph.net.stats['scale'].count == 3
+        assert graph.net.stats['mean'].count == 1
+        expected = graph(dict(inputs, x=np.array(x)), outputs=outputs)
+
+        assert results['rowsum'] is rowsum
+        for name in outputs:
+            np.testing.assert_array_equal(results[name], expected[name])
+
+    # fused operations unpickled from graphs saved without their reduce attribute run in blocks too
+    fused = compose(name='fused', fuse=True)(
+        operation(name='scale', needs='x', provides='scaled', chunk_safe=True)(lambda x: x * 2),
+        operation(name='rowsum', needs='scaled', provides='rowsum', chunk_safe=True)(lambda s: s.sum(axis=1)),
+    )
+    for step in fused.net.steps:
+        if getattr(step, 'name', None) == 'scale..rowsum':
+            del step.__dict__['reduce']
+    x = np.arange(12.).reshape(4, 3)
+    results = compute_chunked(fused, ['rowsum'], {'x': x}, chunked=['x'], chunk_size=3)
+    np.testing.assert_array_equal(results['rowsum'], x.sum(axis=1) * 2)
+
+    # operations that need whole arrays can't run in blocks
+    graph = compose(name='unsafe')(operation(name='sort', needs='x', provides='y')(np.sort))
+    assert_raises(ValueError, compute_chunked, graph, ['y'], {'x': np.ones(4)}, ['x'], 2)
+
+
+def test_memory_report():
+
+    import numpy as np
+    from graphkit.memory import MemoryReport
+
+    graph = compose(name='memory')(
+        operation(name='expand', needs='a', provides='big')(lambda a: np.repeat(a, 10)),
+        operation(name='shrink', needs='big', provides='small')(lambda big: big[:5].copy()),
+        operation(name='total', needs='small', provides='total')(lambda small: small.sum()),
+    )
+
+    report = MemoryReport(tracemalloc=True)
+    graph({'a': np.ones(100)}, outputs=['total'], memory=report)
+
+    assert graph.net.memory_report is report
+    assert report.sizes['a'] == 800 and report.sizes['big'] == 8000 and report.sizes['small'] == 40
+
+    # the peak is reached before the input is deleted after expanding it
+    assert report.peak_step == 'expand'
+    assert report.peak_bytes == 8800
+    assert report.peak_alive == [('big', 8000), ('a', 800)]
+    assert ('del a', 8000) in report.timeline and ('del big', 40) in report.timeline
+    assert report.allocated['expand'] >= 8000
+
+    # without a report nothing is recorded
+    graph.net.memory_report = None
+    graph({'a': np.ones(100)}, outputs=['total'])
+    assert graph.net.memory_report is None
+
+
+def test_metrics_registry():
+
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.request import urlopen
+    from graphkit.metrics import MetricsRegistry, start_http_server
+
+    def checked_sub(a, b):
+        if a < b:
+            raise ValueError("negative")
+        return a - b
+
+    graph = compose(name='metrics')(
+        operation(name='sum', needs=['a', 'b'], provides='c')(add),
+        operation(name='diff', needs=['c', 'd'], provides='e')(checked_sub),
+    )
+    registry = MetricsRegistry(buckets=(0.5, 1.0)).attach(graph)
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda i: graph({'a': i, 'b': 1, 'd': 0}, outputs=['e']), range(100)))
+    assert_raises(ValueError, graph, {'a': 0, 'b': 1, 'd': 5}, outputs=['e'])
+
+    snapshot = registry.snapshot()
+    assert snapshot['calls'] == 101
+    assert snapshot['plan_hits'] + snapshot['plan_misses'] == 101
+    assert snapshot['operations']['sum']['count'] == 101
+    assert snapshot['operations']['sum']['buckets'] == [101, 101, 101]
+    assert snapshot['operations']['diff']['count'] == 100
+    assert snapshot['operations']['diff']['errors'] == 1
+
+    text = registry.render_prometheus()
+    assert '# TYPE graphkit_operation_duration_seconds histogram' in text
+    assert 'graphkit_operation_duration_seconds_bucket{operation="sum",le="+Inf"} 101' in text
+    assert 'graphkit_operation_errors_total{operation="diff"} 1' in text
+    assert 'graphkit_calls_total 101' in text
+
+    server = start_http_server(registry)
+    try:
+        body = urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]).read().decode('utf-8')
+        assert 'graphkit_calls_total 101' in body
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # the registry is not pickled with the network
+    assert graph.net.__getstate__()['metrics'] is None
+
+
+def test_coalesce_concurrent_calls():
+
+    import threading
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+
+    release = threading.Event()
+    calls = []
+
+    def slow_sum(a, b):
+        calls.append(a)
+        release.wait(5)
+        if b < 0:
+            raise ValueError("negative")
+        return a.sum() + b
+
+    graph = compose(name='coalesced', coalesce=True)(
+        operation(name='sum', needs=['a', 'b'], provides='c')(slow_sum),
+    )
+    flights = graph._flights
+
+    def run_burst(b):
+        del calls[:]
+        release.clear()
+        shared = flights.shared
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            # equal arrays, not the same objects
+            futures = [pool.submit(graph, {'a': np.arange(4), 'b': b}) for _ in range(8)]
+            deadline = time.time() + 5
+            while flights.shared - shared < 7 and time.time() < deadline:
+                time.sleep(0.001)
+            release.set()
+        return futures
+
+    futures = run_burst(1)
+    assert len(calls) == 1
+    assert [f.result() for f in futures] == [{'c': 7}] * 8
+    # every caller gets a copy of the result
+    assert len(set(id(f.result()) for f in futures)) == 8
+
+    futures = run_burst(-1)
+    assert len(calls) == 1
+    errors = [f.exception() for f in futures]
+    assert all(isinstance(e, ValueError) for e in errors) and len(set(map(id, errors))) == 1
+
+    # calls with different inputs are not coalesced
+    release.set()
+    assert graph({'a': np.arange(3), 'b': 0}) == {'c': 3}
+    assert len(calls) == 2
+
+    # nor are calls with equal inputs of different types
+    from graphkit.singleflight import fingerprint
+    keys = [fingerprint({'a': value}) for value in (1, 1.0, True, (1,), (True,))]
+    assert len(set(keys)) == 5
+    assert fingerprint({'a': (1, [2])}) == fingerprint({'a': (1, [2])})
+
+
+def test_micro_batching():
+
+    import numpy as np
+    from graphkit.batching import MicroBatcher
+
+    batch_sizes = []
+
+    def score(features, weights):
+        batch_sizes.append(len(features))
+        return features.dot(weights)
+
+    def label(score, threshold):
+        return 'high' if score > threshold else 'low'
+
+    graph = compose(name='batched', constants={'weights': np.array([1.0, 2.0])})(
+        operation(name='score', needs=['features', 'weights'], provides='score', batched=True)(score),
+        operation(name='label', needs=['score', 'threshold'], provides='label')(label),
+    )
+
+    with MicroBatcher(graph, max_batch_size=16, max_wait=0.2) as batcher:
+        futures = [batcher.submit({'features': np.array([i, 1.0]), 'threshold': 10}) for i in range(20)]
+        results = [f.result(5) for f in futures]
+
+    for i, result in enumerate(results):
+        assert result == {'score': i + 2.0, 'label': 'high' if i + 2 > 10 else 'low'}
+    # the batched operation ran once per batch, the other once per request
+    assert batch_sizes == [16, 4]
+    assert batcher.batches == 2 and batcher.requests == 20
+    assert graph.net.stats['label'].count == 20
+
+    # a failing request doesn't fail the others in its batch
+    with MicroBatcher(graph, outputs=['label'], max_wait=0.2) as batcher:
+        good = batcher.submit({'features': np.array([1.0, 1.0]), 'threshold': 0})
+        bad = batcher.submit({'features': np.array([1.0, 1.0]), 'threshold': None})
+        assert good.result(5) == {'label': 'high'}
+        assert isinstance(bad.exception(5), TypeError)
+
+
+def test_fuse_chains():
+
+    ops = [
+        operation(name='inc', needs='a', provides='b')(lambda a: a + 1),
+        operation(name='double', needs='b', provides='c')(lambda b: b * 2),
+        operation(name='scale', needs=['c', 'k'], provides=[Var('d', int)])(mul),
+        operation(name='square', needs=[Var('d', int)], provides='e')(lambda d: d * d),
+        # 'd' has a second consumer, so the chain stops there
+        operation(name='neg', needs=[Var('d', int)], provides='f')(lambda d: -d),
+        operation(name='half', needs='f', provides='g')(lambda f: f / 2),
+    ]
+    plain = compose(name='plain')(*ops)
+    fused = compose(name='fused', fuse=True)(*ops)
+
+    assert fused.net.fused_chains == {'inc..scale': ['inc', 'double', 'scale'], 'neg..half': ['neg', 'half']}
+    assert [name for name, _ in fused.net.list_layers()] == ['inc..scale', 'square', 'neg..half']
+    assert set(n for n in fused.net.graph.nodes if isinstance(n, str)) == {'a', 'k', 'd', 'e', 'g'}
+
+    inputs = {'a': 1, 'k': 3}
+    assert fused(inputs) == {k: v for k, v in plain(inputs).items() if k in ('d', 'e', 'g')}
+    assert fused(inputs, outputs=['g']) == plain(inputs, outputs=['g'])
+    assert_raises(ValueError, fused, inputs, outputs=['c'])
+
+    # the inner type checks still apply
+    assert_raises(TypeError, fused, {'a': 1, 'k': 0.5})
+
+    # data to keep visible splits chains
+    kept = compose(name='kept', fuse=['c'])(*ops)
+    assert kept.net.fused_chains == {'inc..double': ['inc', 'double'], 'neg..half': ['neg', 'half']}
+    assert kept(inputs, outputs=['c']) == {'c': 4}
+
+
+def test_compact_core_objects():
+
+    import sys
+    from graphkit.network import DataPlaceholderNode, DeleteInstruction
+
+    var = Var(''.join(['da', 'ta']), int, optional=True)
+    assert not hasattr(var, '__dict__')
+    assert var.name is sys.intern('data')
+    clone = pickle.loads(pickle.dumps(var))
+    assert (clone.name, clone.type, clone.optional) == ('data', int, True) and clone == var
+    assert pickle.loads(pickle.dumps(var, protocol=0)) == var
+
+    assert not hasattr(DataPlaceholderNode('a'), '__dict__')
+    assert not hasattr(DeleteInstruction('a'), '__dict__')
+
+    # one node object per data name
+    graph = compose(name='shared')(
+        operation(name='op1', needs=['a'], provides='b')(lambda a: a),
+        operation(name='op2', needs=['a', 'b'], provides='c')(add),
+    )
+    nodes = [n for op in graph.net.graph.nodes if isinstance(op, Operation)
+             for n in graph.net.graph.predecessors(op) if n == 'a']
+    assert len(nodes) == 2 and nodes[0] is nodes[1]
+
+
+def test_compile_cache():
+
+    from graphkit.compile_cache import CompileCache
+
+    def build(**kwargs):
+        return [
+            operation(name='sum', needs=['a', 'b'], provides='c')(add),
+            operation(name='mul', needs=['c', 'b'], provides='d', **kwargs)(mul),
+            operation(name='sub', needs=['d', 'a'], provides='e')(sub),
+        ]
+
+    def step_names(net):
+        return [getattr(step, 'name', str(step)) for step in net.steps]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompileCache(directory=tmp)
+        first = compose(name='first', compile_cache=cache)(*build())
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert first({'a': 1, 'b': 2}, outputs=['e']) == {'e': 5}
+
+        # new plans are written in the background, or when flushed
+        cache.flush()
+
+        # a structurally identical graph in another process reuses steps and plans
+        cache = CompileCache(directory=tmp)
+        second = compose(name='second', compile_cache=cache)(*build())
+        assert (cache.hits, cache.misses) == (1, 0)
+        assert second.net.fingerprint() == first.net.fingerprint()
+        assert step_names(second.net) == step_names(first.net)
+        assert len(second.net._necessary_steps_cache) == 1
+        assert second({'a': 1, 'b': 2}, outputs=['e']) == {'e': 5}
+        assert second({'a': 1, 'b': 2}) == {'c': 3, 'd': 6, 'e': 5}
+
+        # any structural difference changes the fingerprint
+        colored = compose(name='colored', compile_cache=cache)(*build(color='red'))
+        assert colored.net.fingerprint() != first.net.fingerprint()
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        # editing the graph detaches it from the cache
+        second.net.add_op(operation(name='neg', needs='e', provides='f')(lambda e: -e))
+        assert second.net._compile_cache is None
+        assert second({'a': 1, 'b': 2}, outputs=['f']) == {'f': -5}
+        cache.close()
+
+    # plans found after the directory is gone are kept in memory
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = CompileCache(directory=os.path.join(tmp, 'plans'))
+        graph = compose(name='gone', compile_cache=cache)(*build())
+    assert graph({'a': 1, 'b': 2}, outputs=['e']) == {'e': 5}
+    cache._flush_later()
+    cache.close()
+    assert len(cache.get(graph.net.fingerprint())['plans']) == 1
+
+
+def test_specialize():
+
+    calls = []
+
+    def parse_config(config):
+        calls.append(config)
+        return dict(config, scale=config['factor'] * 2)
+
+    graph = compose(name='tenant')(
+        operation(name='parse', needs='config', provides='settings')(parse_config),
+        operation(name='scale', needs=['settings', 'x'], provides='y')(lambda s, x: s['scale'] * x),
+        operation(name='shift', needs=['y', modifiers.optional('offset')], provides='z')(
+            lambda y, offset=0: y + offset),
+        operation(name='report', needs=['settings', 'user'], provides='greeting')(lambda s, u: 'hi %s' % u),
+    )
+
+    tenant = graph.net.specialize({'config': {'factor': 3}}, outputs=['z'], name='tenant_a')
+    assert calls == [{'factor': 3}]
+    assert tenant.name == 'tenant_a'
+    assert [(n.name, n.optional) for n in tenant.needs] == [('x', False), ('offset', True)]
+    assert [p.name for p in tenant.provides] == ['z']
+    # only the layers needed for the outputs are kept
+    assert [name for name, _ in tenant.net.list_layers()] == ['scale', 'shift']
+
+    assert tenant({'x': 2}, outputs=['z']) == {'z': 12}
+    assert tenant({'x': 2, 'offset': 1}, outputs=['z']) == {'z': 13}
+    assert calls == [{'factor': 3}]
+
+    # without outputs every layer that still varies is kept
+    full = graph.net.specialize({'config': {'factor': 1}})
+    assert sorted(n.name for n in full.needs) == ['offset', 'user', 'x']
+    results = full({'x': 1, 'user': 'bob'})
+    assert results == {'settings': {'factor': 1, 'scale': 2}, 'y': 2, 'z': 2, 'greeting': 'hi bob'}
+    assert set(results) == set(p.name for p in full.provides)
+
+    # outputs folded away are still returned by calls without outputs
+    folded = graph.net.specialize({'config': {'factor': 3}, 'x': 2}, outputs=['y'])
+    assert [p.name for p in folded.provides] == ['y'] and not folded.needs
+    assert folded({}) == {'y': 12}
+    assert folded.net.compute(None, {}, lazy=True)['y'] == 12
+
+    assert_raises(ValueError, graph.net.specialize, {'config': {}}, ['missing'])
+
+
+def test_deferred_input_loaders():
+
+    import asyncio
+    import threading
+    from concurrent.futures import Future
+    from graphkit.loaders import Loader
+
+    fetched = []
+
+    # fetches waiting here only go on once both run at the same time
+    together = threading.Barrier(2, timeout=5)
+
+    def fetcher(name, value, concurrent=False):
+        def fetch():
+            if concurrent:
+                together.wait()
+            fetched.append(name)
+            return value
+        return fetch
+
+    graph = compose(name='deferred')(
+        operation(name='join', needs=['profile', 'history'], provides='features')(lambda p, h: p + h),
+        operation(name='score', needs=['features', 'weight'], provides='score')(mul),
+        operation(name='audit', needs=['log'], provides='audited')(lambda log: log),
+    )
+
+    # the loaders of one step are resolved concurrently, unused ones never
+    inputs = {'profile': Loader(fetcher('profile', 1, concurrent=True)),
+              'history': Loader(fetcher('history', 2, concurrent=True)),
+              'weight': 10,
+              'log': Loader(fetcher('log', 'x'))}
+    assert graph(inputs, outputs=['score']) == {'score': 30}
+    assert sorted(fetched) == ['history', 'profile']
+
+    # futures and coroutines are loaders too, and requested inputs are resolved
+    future = Future()
+    threading.Timer(0.05, future.set_result, [5]).start()
+
+    async def load_history():
+        await asyncio.sleep(0.01)
+        return 6
+
+    results = graph({'profile': Loader(future), 'history': Loader(load_history()), 'weight': 2},
+                    outputs=['score', 'profile'])
+    assert results == {'score': 22, 'profile': 5}
+
+    # coroutines can be loaded from async code, where an event loop runs
+    async def handler():
+        return graph({'profile': 1, 'history': Loader(load_history()), 'weight': 2}, outputs=['score'])
+    assert asyncio.run(handler()) == {'score': 14}
+
+    loop = asyncio.new_event_loop()
+    assert_raises(TypeError, Loader, loop.create_future())
+    loop.close()
+
+    # a failure is raised to the step needing the input
+    def broken():
+        raise IOError("unavailable")
+    assert_raises(IOError, graph, {'profile': Loader(broken), 'history': 1, 'weight': 1}, outputs=['score'])
+
+    # the parallel scheduler resolves loaders as well
+    del fetched[:]
+    with ParallelScheduler(max_workers=2) as scheduler:
+        inputs['log'] = Loader(fetcher('log', 'x'))
+        assert scheduler.compute(graph, ['audited'], inputs) == {'audited': 'x'}
+    assert fetched == ['log']
+
+
+def test_io_bound_prefetch():
+
+    import threading
+
+    events = []
+    crunched = threading.Event()
+
+    def query(user):
+        events.append('query start')
+        # only returns early if a cpu-bound step runs meanwhile
+        events.append('overlapped' if crunched.wait(5) else 'serial')
+        return user * 10
+
+    def crunch(x):
+        events.append('crunch')
+        crunched.set()
+        time.sleep(0.05)
+        return x + 1
+
+    graph = compose(name='prefetch')(
+        operation(name='query', needs=['user'], provides='rows', io_bound=True)(query),
+        operation(name='crunch', needs=['x'], provides='y')(crunch),
+        operation(name='crunch2', needs=['y'], provides='z')(crunch),
+        operation(name='join', needs=['rows', 'z'], provides='out')(add),
+    )
+
+    # the query overlaps the cpu-bound steps, whatever its place in the plan
+    assert graph({'user': 1, 'x': 1}, outputs=['out']) == {'out': 13}
+    assert events[0] == 'query start'
+    assert 'overlapped' in events and 'serial' not in events
+    assert graph.net.times['query'] > 0
+
+    # errors are raised when the step is reached
+    def broken(user):
+        raise IOError("timeout")
+    graph = compose(name='prefetch')(
+        operation(name='query', needs=['user'], provides='rows', io_bound=True)(broken),
+        operation(name='crunch', needs=['x'], provides='y')(lambda x: x),
+        operation(name='join', needs=['rows', 'y'], provides='out')(add),
+    )
+    assert_raises(IOError, graph, {'user': 1, 'x': 1}, outputs=['out'])
+
+    # io-bound operations are neither fused nor lost when pickled
+    graph = compose(name='prefetch', fuse=True)(
+        operation(name='prepare', needs=['user'], provides='key')(lambda user: user),
+        operation(name='query', needs=['key'], provides='rows', io_bound=True)(query),
+        operation(name='count', needs=['rows'], provides='n')(lambda rows: rows + 1),
+    )
+    assert 'query' in [step.name for step in graph.net.steps if isinstance(step, Operation)]
+    assert graph({'user': 2}, outputs=['n']) == {'n': 21}
+    op = operation(name='query', needs=['user'], provides='rows', io_bound=True)(add)
+    assert pickle.loads(pickle.dumps(op)).io_bound
+
+
+def test_resource_aware_scheduler():
+
+    import threading
+
+    lock = threading.Lock()
+    active = {'n': 0, 'peak': 0}
+
+    def hungry(x):
+        with lock:
+            active['n'] += 1
+            active['peak'] = max(active['peak'], active['n'])
+        time.sleep(0.05)
+        with lock:
+            active['n'] -= 1
+        return x
+
+    ops = [operation(name='load%d' % i, needs=['a'], provides='d%d' % i, resources={'mem_gb': 4})(hungry)
+           for i in range(6)]
+    ops.append(operation(name='light', needs=['a'], provides='e')(hungry))
+    graph = compose(name='resources')(*ops)
+    outputs = ['d%d' % i for i in range(6)] + ['e']
+
+    # at most two 4GB operations at once, while the light one runs alongside
+    with ParallelScheduler(max_workers=4, resources={'mem_gb': 8}) as scheduler:
+        results = scheduler.compute(graph, outputs, {'a': 1})
+        assert results == dict.fromkeys(outputs, 1)
+        assert active['peak'] == 3
+        stats = scheduler.resource_stats()['mem_gb']
+        assert stats['capacity'] == 8 and stats['in_use'] == 0 and stats['peak'] == 8
+        assert stats['acquired'] == 6
+        assert stats['queued'] == 4
+        assert stats['max_wait'] >= 0.04
+
+    # limits hold across calls sharing the scheduler
+    active['peak'] = 0
+    with ParallelScheduler(max_workers=8, resources={'mem_gb': 8}) as scheduler:
+        threads = [threading.Thread(target=scheduler.compute, args=(graph, outputs[:-1], {'a': 1}))
+                   for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert active['peak'] == 2
+
+    # an operation needing more than the capacity could never run
+    with ParallelScheduler(resources={'mem_gb': 2}) as scheduler:
+        assert_raises(ValueError, scheduler.compute, graph, ['d0'], {'a': 1})
+
+    # operations pickled without resources, e.g. nested or fused, hold none
+    inner = compose(name='inner')(operation(name='double', needs=['a'], provides='b')(abs))
+    fused = compose(name='fused', fuse=True)(
+        operation(name='neg', needs=['b'], provides='c')(abs),
+        operation(name='plus', needs=['c', 'a'], provides='d')(add),
+    )
+    nested = compose(name='outer')(inner, operation(name='sum', needs=['a', 'b'], provides='c')(add))
+    for graph, output in ((nested, 'c'), (compose(name='outer')(inner, fused), 'd')):
+        graph = pickle.loads(pickle.dumps(graph))
+        with ParallelScheduler(max_workers=2, resources={'mem_gb': 8}) as scheduler:
+            assert scheduler.compute(graph, [output], {'a': -1}) == {output: 0}
+
+    # and operations unpickled from older versions can be pickled again
+    op = FunctionalOperation.__new__(FunctionalOperation)
+    op.__setstate__({'name': 'sum', 'needs': [Var('a'), Var('b')], 'provides': [Var('c')],
+                     'params': {}, 'fn': add, 'color': None})
+    graph = pickle.loads(pickle.dumps(compose(name='old')(op)))
+    with ParallelScheduler(max_workers=2, resources={'mem_gb': 8}) as scheduler:
+        assert scheduler.compute(graph, ['c'], {'a': 1, 'b': 2}) == {'c': 3}
+
+
+def test_weighted_fair_scheduling():
+
+    import threading
+
+    done = []
+
+    def slow(name):
+        def run(x):
+            time.sleep(0.05)
+            done.append(name)
+            return x
+        return run
+
+    batch = compose(name='batch')(*[operation(name='b%d' % i, needs=['a'], provides='b%d' % i)(slow('batch'))
+                                    for i in range(12)])
+    interactive = compose(name='interactive')(
+        operation(name='i0', needs=['a'], provides='i0')(slow('interactive')),
+        operation(name='i1', needs=['i0'], provides='i1')(slow('interactive')),
+        operation(name='i2', needs=['i1'], provides='i2')(slow('interactive')),
+    )
+
+    with ParallelScheduler(max_workers=2, weights={'interactive': 8, 'batch': 1}) as scheduler:
+        threads = [threading.Thread(target=scheduler.compute, args=(batch, None, {'a': 1}),
+                                    kwargs={'priority': 'batch'})
+                   for _ in range(3)]
+        for t in threads:
+            t.start()
+        time.sleep(0.02)
+
+        # the interactive call doesn't queue behind the 36 operations of the batch calls
+        assert scheduler.compute(interactive, ['i2'], {'a': 1}, priority='interactive') == {'i2': 1}
+        assert done.count('batch') < 12
+        for t in threads:
+            t.join()
+
+        assert scheduler.latency['interactive'].count == 1
+        assert scheduler.latency['batch'].count == 3
+        assert scheduler.latency['batch'].estimate('max') > scheduler.latency['interactive'].ewma
+
+
+def test_streaming_operations():
+
+    import tracemalloc
+    from collections import deque
+
+    events = deque(maxlen=6)
+
+    @operation(name='read', needs=['n'], provides='records', stream=True)
+    def read(n):
+        for i in range(n):
+            events.append('read')
+            yield 'record %d' % i
+
+    @operation(name='parse', needs=['records'], provides='rows', stream=True)
+    def parse(records):
+        for record in records:
+            events.append('parse')
+            yield len(record)
+
+    @operation(name='total', needs=['rows'], provides='total', stream=True)
+    def total(rows):
+        return sum(rows)
+
+    graph = compose(name='pipeline')(read, parse, total)
+
+    # items are pulled through the pipeline one at a time
+    assert graph({'n': 3}, outputs=['total']) == {'total': 24}
+    assert list(events) == ['read', 'parse'] * 3
+
+    tracemalloc.start()
+    graph({'n': 200000}, outputs=['total'])
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < 1e6
+
+    # streams requested, with several consumers, or needed by operations
+    # that don't stream are materialized
+    results = graph({'n': 2}, outputs=['total', 'rows'])
+    assert results == {'total': 16, 'rows': [8, 8]}
+    assert graph({'n': 2}) == {'records': ['record 0', 'record 1'], 'rows': [8, 8], 'total': 16}
+
+    graph = compose(name='pipeline')(
+        read, parse,
+        operation(name='first', needs=['rows'], provides='first')(lambda rows: rows[0]),
+    )
+    assert graph({'n': 2}, outputs=['first']) == {'first': 8}
+
+    # the parallel scheduler materializes streams
+    with ParallelScheduler(max_workers=2) as scheduler:
+        assert scheduler.compute(graph, ['first'], {'n': 2}) == {'first': 8}
+
+    # streams are neither folded into constants nor shared between duplicates
+    graph = compose(name='pipeline', constants={'n': 3})(read, parse, total)
+    assert graph({}, outputs=['total']) == {'total': 24}
+    assert graph({}, outputs=['total']) == {'total': 24}
+    graph = compose(name='pipeline', cse=True)(
+        read, parse,
+        operation(name='read2', needs=['n'], provides='records2', stream=True)(read.fn),
+        operation(name='total2', needs=['records2'], provides='total2', stream=True)(lambda r: len(list(r))),
+    )
+    assert graph.net.cse_merges == {}
+    assert graph({'n': 2}, outputs=['rows', 'total2']) == {'rows': [8, 8], 'total2': 2}
+
+    op = operation(name='merge', needs=['a', 'b'], provides='c', stream=True)(add)
+    assert pickle.loads(pickle.dumps(op)).stream
+
+
+def test_checkpoint_and_resume():
+
+    import numpy as np
+    from graphkit.checkpoint import Checkpoint
+
+    calls, mapped = [], []
+    crash = {'on': True}
+
+    def expand(a):
+        calls.append('expand')
+        return np.arange(a, dtype=float)
+
+    def scale(x):
+        calls.append('scale')
+        return x * 2
+
+    def total(y):
+        calls.append('total')
+        mapped.append(isinstance(y, np.memmap))
+        if crash['on']:
+            raise RuntimeError("power outage")
+        return float(y.sum())
+
+    graph = compose(name='nightly')(
+        operation(name='expand', needs=['a'], provides='x')(expand),
+        operation(name='scale', needs=['x'], provides='y')(scale),
+        operation(name='total', needs=['y'], provides='total')(total),
+    )
+    directory = os.path.join(tempfile.mkdtemp(), 'nightly')
+
+    checkpoint = Checkpoint(directory, mmap_threshold=1024)
+    assert_raises(RuntimeError, graph.net.compute, ['total'], {'a': 1000}, checkpoint=checkpoint)
+    assert calls == ['expand', 'scale', 'total']
+    assert checkpoint.saves == 2
+
+    # deleted data is not saved, large arrays are saved in files of their own
+    assert len([f for f in os.listdir(directory) if f.endswith('.npy')]) == 1
+
+    # the steps done are skipped, arrays are memory-mapped
+    del calls[:]
+    crash['on'] = False
+    results = graph.net.compute(['total'], {'a': 1000}, checkpoint=directory, resume_from=directory)
+    assert results == {'total': 999000.0}
+    assert calls == ['total']
+    assert mapped == [False, True]
+
+    # a checkpoint of another plan is refused
+    assert_raises(ValueError, graph.net.compute, ['y'], {'a': 1000}, resume_from=directory)
+
+    # only after the selected operations
+    other = os.path.join(tempfile.mkdtemp(), 'nightly')
+    checkpoint = Checkpoint(other, after=['expand'])
+    assert graph.net.compute(['total'], {'a': 10}, checkpoint=checkpoint) == {'total': 90.0}
+    assert checkpoint.saves == 1
+    del calls[:]
+    assert graph.net.compute(['total'], {'a': 10}, resume_from=other) == {'total': 90.0}
+    assert calls == ['scale', 'total']
+
+
+# how many times _WorkerState was initialized, by process
+_worker_inits = {}
+
+
+class _WorkerState(FunctionalOperation):
+    """Reports how many times it was initialized in the process running it."""
+
+    def _after_init(self):
+        pid = os.getpid()
+        _worker_inits[pid] = _worker_inits.get(pid, 0) + 1
+
+    def _compute(self, named_inputs, outputs=None):
+        pid = os.getpid()
+        return {'state': (pid, _worker_inits[pid])}
+
+
+def test_sharded_runner():
+
+    from graphkit.sharding import ShardedRunner
+
+    graph = compose(name='sharded')(
+        operation(name='sum', needs=['a', 'b'], provides='c')(add),
+        operation(name='prod', needs=['c', 'k'], provides='d')(mul),
+        _WorkerState(name='state', needs=[Var('a')], provides=[Var('state')], fn=None),
+    )
+    records = [{'a': i, 'b': 1} for i in range(50)]
+
+    with ShardedRunner(graph, processes=2, shard_size=7) as runner:
+        results = runner.map(records, outputs=['d', 'state'], shared={'k': 2})
+
+        # results are merged in the order of the records
+        assert [r['d'] for r in results] == [2 * (i + 1) for i in range(50)]
+        assert [s['records'] for s in runner.shards] == [7] * 7 + [1]
+        assert [s['shard'] for s in runner.shards] == list(range(8))
+        assert all(s['throughput'] > 0 for s in runner.shards)
+
+        # every worker unpickled the graph once and reused it for all its shards
+        workers = set(s['worker'] for s in runner.shards)
+        assert 1 <= len(workers) <= 2 and os.getpid() not in workers
+        assert set(inits for _, inits in (r['state'] for r in results)) == {1}
+
+        # later batches reuse the graph unpickled by the workers too
+        results = runner.map(records, outputs=['state'], shared={'k': 2})
+        assert set(inits for _, inits in (r['state'] for r in results)) == {1}
+
+        assert runner.map([], outputs=['d'], shared={'k': 2}) == []